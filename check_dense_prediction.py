@@ -0,0 +1,111 @@
+from __future__ import division
+
+import collections
+import lasagne
+import nibabel
+import numpy as np
+import pecdeeplearn as pdl
+import sys
+import theano
+
+
+# Check that dense (whole slice) prediction gives the same probabilities as
+# patchwise prediction, using a small ACS net on a synthetic volume.  Exits
+# with a non-zero status if they differ.
+
+np.random.seed(0)
+lasagne.random.set_rng(np.random.RandomState(0))
+
+# Create a synthetic volume with a box segmented, and some landmarks.
+shape = (40, 44, 38)
+header = nibabel.Nifti1Header()
+header.set_data_shape(shape)
+header.set_zooms((1.5, 0.8, 2.0))
+mri_data = np.random.randn(*shape).astype('float32')
+seg_data = np.zeros(shape, dtype='int16')
+seg_data[10:30, 11:33, 9:28] = 1
+landmarks = {'Sternal angle': np.array([10., 20., 5.]),
+             'Left nipple': np.array([30., 2., 15.]),
+             'Right nipple': np.array([3., 12., 25.])}
+volume = pdl.extraction.Volume('synthetic', header, np.eye(4), mri_data,
+                               seg_data, landmarks)
+
+# Build a net with a three layer convolutional branch for each of the axial,
+# coronal and sagittal patches, and a landmark branch.
+layers = collections.OrderedDict()
+
+
+def add(layer):
+    layers[layer.name] = layer
+    return layer
+
+
+flatten_layers = []
+for plane in ['a', 'c', 's']:
+    name = 'local_' + plane + '_patch'
+    layer = add(lasagne.layers.InputLayer((None, 1, 25, 25), name=name))
+    for i, num_filters in enumerate([4, 5, 6]):
+        layer = add(lasagne.layers.Conv2DLayer(
+            layer, num_filters, (3, 3), name=name + '_conv' + str(i + 1)))
+        layer = add(lasagne.layers.MaxPool2DLayer(
+            layer, (2, 2), name=name + '_pool' + str(i + 1)))
+    flatten_layers.append(
+        add(lasagne.layers.FlattenLayer(layer, name=name + '_flatten')))
+landmark_layer = add(lasagne.layers.InputLayer((None, 3), name='landmark_1'))
+landmark_dense = add(lasagne.layers.DenseLayer(
+    landmark_layer, 7, W=lasagne.init.Normal(0.001), name='landmark_1_dense'))
+join = add(lasagne.layers.ConcatLayer(flatten_layers + [landmark_dense],
+                                      name='concat'))
+join = add(lasagne.layers.DenseLayer(join, 10, name='join_dense'))
+add(lasagne.layers.DenseLayer(join, 1, W=lasagne.init.Normal(0.01),
+                              nonlinearity=lasagne.nonlinearities.sigmoid,
+                              name='output'))
+
+input_layers = [layer for layer in layers.values()
+                if isinstance(layer, lasagne.layers.InputLayer)]
+predict_function = theano.function(
+    [layer.input_var for layer in input_layers],
+    lasagne.layers.get_output(list(layers.values())[-1], deterministic=True))
+
+
+class Net:
+    """A stand in for a trained nolearn net, with the same interface."""
+
+    layers_ = layers
+
+    def predict(self, input_batch):
+        return predict_function(*[input_batch[layer.name]
+                                  for layer in input_layers])
+
+
+net = Net()
+
+# Create the extractor that the net would have been trained with.
+ext = pdl.extraction.Extractor()
+ext.add_feature('local_a_patch', pdl.extraction.PatchFeature([25, 25, 1]))
+ext.add_feature('local_c_patch', pdl.extraction.PatchFeature([25, 1, 25]))
+ext.add_feature('local_s_patch', pdl.extraction.PatchFeature([1, 25, 25]))
+ext.add_feature('landmark_1',
+                pdl.extraction.LandmarkDisplacementFeature('Left nipple'))
+
+# Compare the predictions, with the default memory budget and with one small
+# enough to force single slice slabs and a few images per branch call.
+bounds = (np.array([10, 12, 13]), np.array([22, 28, 24]))
+patchwise = ext.predict(net, volume, 500, bounds=bounds).seg_data
+failed = False
+for memory_budget in [2 ** 30, 2 ** 13]:
+    predictor = pdl.extraction.DensePredictor(net, ext, slab_size=4,
+                                              memory_budget=memory_budget)
+    dense = predictor.predict(volume, 500, bounds=bounds)
+    max_difference = np.amax(np.abs(dense - patchwise))
+    print('Memory budget ' + str(memory_budget) + ': maximum difference ' +
+          str(max_difference) + '.')
+    failed = failed or max_difference > 1e-5
+
+# Check that the predictions cover the same points.
+if np.count_nonzero(dense) != np.count_nonzero(patchwise):
+    print('The dense and patchwise predictions cover different points.')
+    failed = True
+
+print('FAILED' if failed else 'OK')
+sys.exit(1 if failed else 0)
@@ -1,4 +1,12 @@
 from .extractor import *
+from .dense import *
+from .ensemble import *
 from .features import *
+from .cascade import *
 from .maps import *
+from .pointset import *
+from .prefetch import *
+from .roi import *
+from .shared import *
+from .sinks import *
 from .volume import *
\ No newline at end of file
@@ -0,0 +1,177 @@
+from __future__ import division
+
+import numpy as np
+
+from .maps import probability_bins
+
+
+class Cascade:
+    """
+    A cheap first stage that rejects voxels that are almost never segmented.
+
+    Args
+        threshold (float): voxels whose intensity bin has a probability of
+            being segmented below this are rejected.
+        num_bins (int): the number of intensity bins (see probability_bins).
+        landmark_name (str): the name of an optional landmark to gate on.
+            Voxels further from it than any segmented training voxel (plus
+            distance_margin) are rejected.
+        distance_margin (float): the extra distance (in mm) allowed by the
+            landmark gate.
+
+    Attributes
+        threshold (float): equals arg.
+        num_bins (int): equals arg.
+        landmark_name (str): equals arg.
+        distance_margin (float): equals arg.
+        bins (numpy.ndarray): the intensity bin boundaries.
+        prob_bins (numpy.ndarray): the probability that a voxel in each bin
+            is segmented.
+        max_distance (float): the largest distance from the landmark that is
+            accepted, or None if there is no landmark gate.
+        prior (float): the probability given to rejected voxels, which is the
+            fraction of rejected training voxels that are segmented.
+        training_recall (float): the fraction of segmented training voxels
+            that are accepted.
+
+    Notes
+        The cascade must be fitted to the training volumes before use.
+        Lower thresholds (or larger margins) give a higher recall, at the
+        cost of sending more voxels to the net.
+
+    """
+
+    def __init__(self, threshold=0.01, num_bins=25, landmark_name=None,
+                 distance_margin=10.0):
+
+        self.threshold = threshold
+        self.num_bins = num_bins
+        self.landmark_name = landmark_name
+        self.distance_margin = distance_margin
+
+        # Initialise the fitted values.
+        self.bins = None
+        self.prob_bins = None
+        self.max_distance = None
+        self.prior = 0.0
+        self.training_recall = None
+
+    def fit(self, volumes):
+        """Learn the intensity model and landmark gate from volumes."""
+
+        self.bins, prob_bins = probability_bins(volumes,
+                                                num_bins=self.num_bins)
+
+        # Never reject bins that had no training voxels in them.
+        self.prob_bins = np.where(np.isnan(prob_bins), 1.0, prob_bins)
+
+        # Find the furthest that any segmented voxel lies from the landmark.
+        self.max_distance = None
+        if self.landmark_name is not None:
+            max_distance = 0.0
+            for volume in volumes:
+                points = np.argwhere(volume.seg_data)
+                if len(points) > 0:
+                    max_distance = max(max_distance, np.amax(
+                        self._landmark_distances(volume, points)))
+            self.max_distance = max_distance + self.distance_margin
+
+        # Find the recall and the probability of rejected voxels.
+        seg_count = 0
+        accepted_seg_count = 0
+        rejected_count = 0
+        rejected_seg_count = 0
+        for volume in volumes:
+            accepted = self.accept_box(volume, [0, 0, 0], volume.shape)
+            segmented = volume.seg_data.astype('bool')
+            seg_count += np.count_nonzero(segmented)
+            accepted_seg_count += np.count_nonzero(accepted & segmented)
+            rejected_count += np.count_nonzero(~accepted)
+            rejected_seg_count += np.count_nonzero(~accepted & segmented)
+
+        self.training_recall = \
+            accepted_seg_count / seg_count if seg_count > 0 else 1.0
+        self.prior = \
+            rejected_seg_count / rejected_count if rejected_count > 0 else 0.0
+
+        return self
+
+    def recall(self, volumes):
+        """Get the fraction of segmented voxels that a cascade accepts."""
+
+        seg_count = 0
+        accepted_seg_count = 0
+        for volume in volumes:
+            points = np.argwhere(volume.seg_data)
+            seg_count += len(points)
+            accepted_seg_count += \
+                np.count_nonzero(self.accept(volume, points))
+
+        return accepted_seg_count / seg_count if seg_count > 0 else 1.0
+
+    def _landmark_distances(self, volume, points):
+        """An internal method to find the distances of points (in mm)."""
+
+        landmark = volume.landmark_array([self.landmark_name])[0]
+
+        return np.sqrt(np.sum((points * volume.spacing - landmark) ** 2,
+                              axis=1))
+
+    def _intensity_probabilities(self, intensities):
+        """An internal method to look up the bin probability of intensities."""
+
+        # Intensities outside the training range go in the end bins.
+        bin_indices = np.clip(np.digitize(intensities, self.bins) - 1, 0,
+                              len(self.prob_bins) - 1)
+
+        return self.prob_bins[bin_indices]
+
+    def accept(self, volume, points):
+        """
+        Find which points should be passed on to the net.
+
+        Args
+            volume (Volume): the volume containing the points.
+            points (numpy.ndarray): an (N, 3) array of coordinates.
+
+        Returns
+            accepted (numpy.ndarray): an N element boolean array.
+
+        """
+
+        if self.bins is None:
+            raise Exception('The cascade must be fitted before use.')
+
+        points = np.asarray(points).reshape(-1, 3)
+        intensities = volume.mri_data[tuple(points.T)]
+        accepted = self._intensity_probabilities(intensities) >= \
+            self.threshold
+
+        if self.max_distance is not None:
+            accepted &= self._landmark_distances(volume, points) <= \
+                self.max_distance
+
+        return accepted
+
+    def accept_box(self, volume, lows, highs):
+        """Find which points of a box (as from valid_box) are accepted."""
+
+        if self.bins is None:
+            raise Exception('The cascade must be fitted before use.')
+
+        box_slices = tuple(slice(low, high) for low, high in zip(lows, highs))
+        accepted = self._intensity_probabilities(volume.mri_data[box_slices]) \
+            >= self.threshold
+
+        if self.max_distance is not None:
+            landmark = volume.landmark_array([self.landmark_name])[0]
+            squared_distances = 0
+            for axis, (low, high) in enumerate(zip(lows, highs)):
+                axis_shape = [1, 1, 1]
+                axis_shape[axis] = high - low
+                positions = np.arange(low, high).reshape(axis_shape)
+                squared_distances = squared_distances + \
+                    (positions * volume.spacing[axis] - landmark[axis]) ** 2
+            accepted &= squared_distances <= self.max_distance ** 2
+
+        return accepted
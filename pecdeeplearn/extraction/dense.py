@@ -0,0 +1,349 @@
+from __future__ import division
+
+import numpy as np
+
+from .features import PatchFeature, odd_kernel_shape
+from .extractor import batch_adapter
+
+
+class DensePredictor:
+    """
+    Predict segmentations by running convolutional branches over whole slices.
+
+    Args
+        net (nolearn.lasagne.NeuralNet): a trained net whose convolutional
+            branches each take one 2D patch feature as input, and are made of
+            Conv2DLayers and MaxPool2DLayers (plus any DropoutLayers), ending
+            in a FlattenLayer.  All other inputs are extracted per voxel.
+        extractor (Extractor): the extractor used to train the net.  The
+            features of the convolutional branches must be PatchFeatures with
+            exactly one singleton kernel dimension.
+        slab_size (int): the largest thickness (along the first axis) of the
+            slabs that the prediction region is processed in.  Larger slabs
+            waste less work on overlapping borders, but need more memory.
+        memory_budget (int): the number of bytes that the dense branch
+            outputs of a slab (and the activations of each call to a branch)
+            should fit in.  Slabs are made thinner, down to a single slice,
+            to fit.
+
+    Attributes
+        branches (list): a list of dictionaries describing each convolutional
+            branch (its feature name, kernel, slice axis and functions).
+        slab_size (int): equals arg.
+        memory_budget (int): equals arg.
+
+    Notes
+        Each valid (unpadded) convolution is applied to a whole slice, and
+        each max pool is applied with a stride of 1, with the convolutions
+        and pools after it dilated by the product of the earlier pool
+        strides.  The value at a slice position is then exactly the branch
+        output for the patch whose corner is at that position, so every
+        voxel's branch output is computed once instead of once per patch that
+        contains it.  The dense (fully connected) head is still evaluated per
+        voxel, with each batch's branch features gathered from the dense
+        outputs as it is needed.  Requires Theano 0.9 or later (for dilated
+        convolutions).
+
+    """
+
+    def __init__(self, net, extractor, slab_size=16, memory_budget=2 ** 30):
+
+        import theano
+        import theano.tensor as T
+        import lasagne
+
+        self.extractor = extractor
+        self.slab_size = slab_size
+        self.memory_budget = memory_budget
+
+        # Find the convolutional branches, which end in flatten layers.
+        self.branches = []
+        for layer in net.layers_.values():
+            if isinstance(layer, lasagne.layers.FlattenLayer):
+                branch = self._find_branch(layer, lasagne)
+                if branch is not None:
+                    self.branches.append(branch)
+
+        if len(self.branches) == 0:
+            raise Exception('The net has no convolutional branches.')
+
+        # Compile a dense function for each branch.
+        for branch in self.branches:
+            images = T.tensor4('images')
+            dense_output, dilation = self._dense_expression(
+                branch['layers'], images, T, lasagne)
+            branch['dilation'] = dilation
+            branch['function'] = theano.function([images], dense_output)
+
+        # Any input layers that aren't part of a branch are fed with features
+        # extracted at each voxel.
+        branch_names = [branch['name'] for branch in self.branches]
+        self.point_inputs = [
+            layer for layer in net.layers_.values()
+            if isinstance(layer, lasagne.layers.InputLayer) and
+            layer.name not in branch_names
+        ]
+
+        # Compile the head, with the flatten layers replaced by the dense
+        # branch outputs.
+        head_inputs = {}
+        head_variables = []
+        for branch in self.branches:
+            variable = T.matrix(branch['name'])
+            head_inputs[branch['flatten_layer']] = variable
+            head_variables.append(variable)
+        for layer in self.point_inputs:
+            head_inputs[layer] = layer.input_var
+            head_variables.append(layer.input_var)
+        output_layer = list(net.layers_.values())[-1]
+        head_output = lasagne.layers.get_output(output_layer, head_inputs,
+                                                deterministic=True)
+        self.head_function = theano.function(head_variables, head_output)
+
+    def _find_branch(self, flatten_layer, lasagne):
+        """An internal method to describe the branch behind a flatten layer."""
+
+        # Walk back to the input layer.
+        layers = []
+        layer = flatten_layer.input_layer
+        while not isinstance(layer, lasagne.layers.InputLayer):
+            if not isinstance(layer, (lasagne.layers.Conv2DLayer,
+                                      lasagne.layers.MaxPool2DLayer,
+                                      lasagne.layers.DropoutLayer)):
+                return None
+            layers.insert(0, layer)
+            layer = layer.input_layer
+
+        # Only branches with convolutions benefit from dense prediction.
+        if not any(isinstance(layer, lasagne.layers.Conv2DLayer)
+                   for layer in layers):
+            return None
+
+        # The input must be a 2D patch from the extractor.
+        feature = self.extractor.batch_features.get(layer.name)
+        if not isinstance(feature, PatchFeature):
+            raise Exception('Feature ' + str(layer.name) +
+                            ' must be a PatchFeature for dense prediction.')
+        kernel_shape = odd_kernel_shape(feature.kernel_shape)
+        if list(kernel_shape).count(1) != 1:
+            raise Exception('Feature ' + str(layer.name) +
+                            ' must be a 2D patch for dense prediction.')
+
+        # Record the shape of the data reaching the flatten layer for a
+        # single patch, and the most channels of any layer.
+        _, num_channels, final_rows, final_cols = flatten_layer.input_shape
+        max_channels = max([num_channels] +
+                           [branch_layer.num_filters
+                            for branch_layer in layers
+                            if isinstance(branch_layer,
+                                          lasagne.layers.Conv2DLayer)])
+
+        return {'name': layer.name,
+                'feature': feature,
+                'kernel_shape': kernel_shape,
+                'slice_axis': list(kernel_shape).index(1),
+                'layers': layers,
+                'flatten_layer': flatten_layer,
+                'num_channels': num_channels,
+                'max_channels': max_channels,
+                'final_shape': (final_rows, final_cols)}
+
+    @staticmethod
+    def _dense_expression(layers, images, T, lasagne):
+        """An internal method to build the dense form of a branch."""
+
+        output = images
+        dilation = 1
+        for layer in layers:
+
+            if isinstance(layer, lasagne.layers.Conv2DLayer):
+                if tuple(layer.stride) != (1, 1) or \
+                        layer.pad not in ('valid', (0, 0), 0) or \
+                        getattr(layer, 'untie_biases', False):
+                    raise Exception('Only unpadded, unit stride convolutions '
+                                    'with tied biases can be made dense.')
+                output = T.nnet.conv2d(
+                    output, layer.W, border_mode='valid',
+                    filter_flip=getattr(layer, 'flip_filters', True),
+                    filter_dilation=(dilation, dilation))
+                if layer.b is not None:
+                    output += layer.b.dimshuffle('x', 0, 'x', 'x')
+                output = layer.nonlinearity(output)
+
+            elif isinstance(layer, lasagne.layers.MaxPool2DLayer):
+                pool_rows, pool_cols = layer.pool_size
+                if tuple(layer.stride) != (pool_rows, pool_cols) or \
+                        pool_rows != pool_cols or \
+                        tuple(layer.pad) != (0, 0) or \
+                        not layer.ignore_border:
+                    raise Exception('Only unpadded, square, non-overlapping '
+                                    'pools can be made dense.')
+
+                # Take the maximum over shifted copies, spaced by the current
+                # dilation.
+                rows = output.shape[2] - (pool_rows - 1) * dilation
+                cols = output.shape[3] - (pool_cols - 1) * dilation
+                pooled = None
+                for i in range(pool_rows):
+                    for j in range(pool_cols):
+                        shifted = output[:, :,
+                                         i * dilation:i * dilation + rows,
+                                         j * dilation:j * dilation + cols]
+                        if pooled is None:
+                            pooled = shifted
+                        else:
+                            pooled = T.maximum(pooled, shifted)
+                output = pooled
+                dilation *= pool_rows
+
+            # Dropout layers are ignored at prediction time.
+
+        return output, dilation
+
+    def _dense_branch(self, branch, volume, lows, highs):
+        """An internal method to run a branch over every slice of a box."""
+
+        kernel_shape = branch['kernel_shape']
+        slice_axis = branch['slice_axis']
+        half_widths = [size // 2 for size in kernel_shape]
+
+        # Crop the data needed for every patch centred within the box.
+        crop = tuple(slice(low - half_width, high + half_width)
+                     for low, high, half_width in
+                     zip(lows, highs, half_widths))
+        if branch['feature'].prob_seg:
+            data = volume.prob_seg_data[crop]
+        else:
+            data = volume.mri_data[crop]
+
+        # Arrange the slices as a batch of single channel images.
+        images = np.moveaxis(data, slice_axis, 0)[:, np.newaxis]
+
+        # Pass the images through the branch a few at a time, so that the
+        # activations of each call fit in the memory budget.
+        image_size = int(np.prod(images.shape[2:]))
+        images_per_call = max(
+            self.memory_budget // (image_size * branch['max_channels'] * 4),
+            1)
+        dense_output = None
+        for start in range(0, len(images), images_per_call):
+            output = branch['function'](np.ascontiguousarray(
+                images[start:start + images_per_call], dtype='float32'))
+            if dense_output is None:
+                dense_output = np.empty((len(images),) + output.shape[1:],
+                                        dtype='float32')
+            dense_output[start:start + len(output)] = output
+
+        return dense_output
+
+    @staticmethod
+    def _gather_features(branch, dense_output, box_points):
+        """An internal method to gather the branch features of some points."""
+
+        # Find the slice holding each point, and its position in the slice.
+        slice_axis = branch['slice_axis']
+        in_plane_axes = [axis for axis in range(3) if axis != slice_axis]
+        image_indices = box_points[:, slice_axis]
+        rows = box_points[:, in_plane_axes[0]]
+        cols = box_points[:, in_plane_axes[1]]
+
+        # Take the outputs belonging to each point, in the same order as a
+        # flatten layer (channels, then rows, then columns).
+        final_rows, final_cols = branch['final_shape']
+        dilation = branch['dilation']
+        rows = rows[:, np.newaxis] + np.arange(final_rows) * dilation
+        cols = cols[:, np.newaxis] + np.arange(final_cols) * dilation
+        features = dense_output[image_indices[:, np.newaxis, np.newaxis], :,
+                                rows[:, :, np.newaxis], cols[:, np.newaxis, :]]
+
+        return np.ascontiguousarray(
+            np.moveaxis(features, 3, 1).reshape(len(box_points), -1))
+
+    def _slab_thickness(self, lows, highs):
+        """An internal method to find a slab thickness that fits in memory."""
+
+        # The dense outputs hold every branch's channels for every voxel.
+        slice_size = int(np.prod([high - low for low, high in
+                                  zip(lows[1:], highs[1:])]))
+        voxel_bytes = 4 * sum(branch['num_channels']
+                              for branch in self.branches)
+
+        return int(min(self.slab_size,
+                       max(self.memory_budget // (slice_size * voxel_bytes),
+                           1)))
+
+    def predict(self, volume, batch_size, bounds=None, out=None):
+        """
+        Predict the segmentation probabilities within bounds.
+
+        Args
+            volume (Volume): the volume to predict on.
+            batch_size (int): the number of voxels to pass through the dense
+                head at once.
+            bounds (tuple): inclusive minimum and maximum indices of the box
+                to predict in, as for Extractor.predict.
+            out (numpy.ndarray): an optional volume sized array to write the
+                probabilities into.
+
+        Returns
+            out (numpy.ndarray): a float32 array the same size as the volume.
+
+        """
+
+        if out is None:
+            out = np.zeros(volume.shape, dtype='float32')
+
+        # Restrict the bounds to where every feature is valid.
+        lows, highs = self.extractor.valid_box(volume, bounds)
+        if any(high <= low for low, high in zip(lows, highs)):
+            return out
+
+        # Process the box in slabs along the first axis.
+        slab_thickness = self._slab_thickness(lows, highs)
+        for slab_low in range(lows[0], highs[0], slab_thickness):
+            slab_lows = [slab_low] + list(lows[1:])
+            slab_highs = [min(slab_low + slab_thickness, highs[0])] + \
+                list(highs[1:])
+            slab_shape = [high - low for low, high in
+                          zip(slab_lows, slab_highs)]
+
+            # Run every branch over the whole slab.
+            dense_outputs = [
+                self._dense_branch(branch, volume, slab_lows, slab_highs)
+                for branch in self.branches]
+
+            # Create the points of the slab in raster order.
+            box_points = np.array(np.unravel_index(
+                np.arange(int(np.prod(slab_shape))), slab_shape)).T
+            points = box_points + np.array(slab_lows)
+
+            # Evaluate the head in batches.
+            slab_output = np.empty(len(points), dtype='float32')
+            for start in range(0, len(points), batch_size):
+                stop = min(start + batch_size, len(points))
+                inputs = [self._gather_features(branch, dense_output,
+                                                box_points[start:stop])
+                          for branch, dense_output in
+                          zip(self.branches, dense_outputs)]
+                for layer in self.point_inputs:
+                    inputs.append(self._point_input(layer.name, volume,
+                                                    points[start:stop]))
+                slab_output[start:stop] = \
+                    np.ravel(self.head_function(*inputs))
+
+            out[tuple(slice(low, high) for low, high in
+                      zip(slab_lows, slab_highs))] = \
+                slab_output.reshape(slab_shape)
+
+        return out
+
+    def _point_input(self, feature_name, volume, points):
+        """An internal method to extract a non-branch feature for points."""
+
+        batch_function = self.extractor.batch_features.get(feature_name)
+        if batch_function is None:
+            batch_function = \
+                batch_adapter(self.extractor.features[feature_name])
+
+        return np.asarray(batch_function(volume, points, None),
+                          dtype='float32')
@@ -0,0 +1,87 @@
+from __future__ import division
+
+import numpy as np
+
+
+class FlipTransform:
+    """
+    A test time transform that flips the data of an input batch.
+
+    Args
+        axis (int): the axis of each feature's data array to flip along
+            (where axis 0 runs over the points of the batch).
+        feature_names (list): the names of the features to flip, or None to
+            flip every feature.
+
+    Attributes
+        axis (int): equals arg.
+        feature_names (list): equals arg.
+
+    Notes
+        Only features whose meaning is unchanged by the flip (e.g. patches)
+        should be flipped.  Displacement features, for example, would need
+        their signs changing instead.
+
+    """
+
+    def __init__(self, axis, feature_names=None):
+        self.axis = axis
+        self.feature_names = feature_names
+
+    def _transform(self, data):
+        return np.ascontiguousarray(np.flip(data, self.axis))
+
+    def __call__(self, input_batch):
+        return _apply_to_features(input_batch, self._transform,
+                                  self.feature_names)
+
+    def __repr__(self):
+        return '{}(axis={!r}, feature_names={!r})'.format(
+            self.__class__.__name__, self.axis, self.feature_names)
+
+
+class IntensityTransform:
+    """
+    A test time transform that rescales the data of an input batch.
+
+    Args
+        scale (float): the factor to multiply the data by.
+        shift (float): the value to add to the data after scaling.
+        feature_names (list): the names of the features to transform, or None
+            to transform every feature.
+
+    Attributes
+        scale (float): equals arg.
+        shift (float): equals arg.
+        feature_names (list): equals arg.
+
+    """
+
+    def __init__(self, scale=1.0, shift=0.0, feature_names=None):
+        self.scale = scale
+        self.shift = shift
+        self.feature_names = feature_names
+
+    def _transform(self, data):
+        return (data * self.scale + self.shift).astype(data.dtype)
+
+    def __call__(self, input_batch):
+        return _apply_to_features(input_batch, self._transform,
+                                  self.feature_names)
+
+    def __repr__(self):
+        return '{}(scale={!r}, shift={!r}, feature_names={!r})'.format(
+            self.__class__.__name__, self.scale, self.shift,
+            self.feature_names)
+
+
+def _apply_to_features(input_batch, transform, feature_names):
+    """An internal function to transform some features of an input batch."""
+
+    # A single array is the only feature.
+    if not isinstance(input_batch, dict):
+        return transform(input_batch)
+
+    return dict((name, transform(data)
+                 if feature_names is None or name in feature_names else data)
+                for name, data in input_batch.items())
@@ -2,8 +2,14 @@ from __future__ import division
 
 import numpy as np
 import copy
-
-from .features import FeatureError
+import multiprocessing
+import time
+import traceback
+
+from .features import Feature, FeatureError
+from .pointset import PointSet, as_point_set
+from .prefetch import Prefetcher
+from .sinks import ArraySink
 from .volume import Volume
 
 
@@ -20,15 +26,66 @@ class Extractor:
                 volume (Volume object),
                 point (3 element tuple)
             )
+        batch_features (dict): a dictionary with keys as feature names, and
+            values as functions that extract data for many points at once.
+            Each batch feature function should have the following form
+            exactly:
+            batch_function(
+                volume (Volume object),
+                points (N x 3 numpy.ndarray),
+                out (numpy.ndarray of shape (N,) + feature size, or None)
+            )
+            and should write into (and return) out, or return a new array if
+            out is None.
         feature_sizes (dict): a dictionary with keys as feature names, and
             values as tuples that give the dimension of the data produced by
             extracting that feature from a volume.
+        feature_margins (dict): a dictionary with keys as feature names, and
+            values as 3 element tuples giving the half-widths of the region a
+            feature reads around a point, or None if this is unknown.
+        discarded_points (dict): a dictionary with keys as volume names, and
+            values as the number of points in the most recent map used for
+            that volume that were discarded because some feature could not be
+            extracted there.  Points outside the feature margins are counted
+            as soon as the map is given, and points where a feature raises a
+            FeatureError are added as extraction reaches them.
+        network_evaluations (dict): a dictionary with keys as volume names,
+            and values as dictionaries giving the number of points the net
+            was evaluated on by the most recent prediction for that volume
+            ('evaluations'), and the number of evaluations that were skipped
+            compared with evaluating every point ('saved').
+        prediction_times (dict): the total time (in seconds) that the most
+            recent patchwise prediction spent extracting batches
+            ('extraction'), evaluating the net ('network'), and waiting for
+            batches to be extracted before the net could continue ('stall').
+
+    Notes
+        When every feature has a batch function, batches are extracted with
+        one call per feature instead of one call per feature per point.
+        Per-point functions can be given a batch form with batch_adapter().
+        Feature specifications (see features.Feature) are batch functions
+        that also declare their sizes and margins, and an extractor that only
+        uses them (or adapted module-level functions) can be pickled.
+
+        Points closer to the volume edge than the feature margins are removed
+        from each map up front, so extraction only needs to handle
+        FeatureErrors for features with unknown margins.
+
+        Point maps may be given as PointSets (as returned by the map
+        functions) or as volume sized arrays, which are converted to
+        PointSets.  Either way, only the points themselves are ever stored.
 
     """
 
     def __init__(self):
         self.features = {}
+        self.batch_features = {}
         self.feature_sizes = {}
+        self.feature_margins = {}
+        self.discarded_points = {}
+        self.network_evaluations = {}
+        self.prediction_times = {}
+        self._dense_predictor = None
 
     def _create_data_arrays(self, batch_size):
         """An internal method to create arrays for a specified batch size."""
@@ -45,51 +102,243 @@ class Extractor:
 
         return input_batch, output_batch, point_batch
 
+    def _create_data_ring(self, batch_size, ring_size):
+        """An internal method to create a ring of sets of data arrays."""
+
+        return [self._create_data_arrays(batch_size)
+                for _ in range(ring_size)]
+
     @staticmethod
-    def _process_input_batch(input_batch, clean_input):
+    def _process_input_batch(input_batch, clean_input, copy_batch=True):
         """An internal method to copy an input batch and process its format."""
 
         # nolearn expects single inputs to be an array (not a dictionary), so
-        # apply this formatting if required to input_batch and return a copy.
+        # apply this formatting if required to input_batch and return a copy
+        # (or the batch itself, if copying has been turned off).
         if clean_input and len(input_batch.keys()) == 1:
-            return copy.deepcopy(input_batch.values()[0])
-        else:
+            input_batch = list(input_batch.values())[0]
+
+        if copy_batch:
             return copy.deepcopy(input_batch)
+        else:
+            return input_batch
+
+    def _process_batch(self, data_arrays, clean_input, copy_batch):
+        """An internal method to prepare a set of data arrays for yielding."""
+
+        input_batch, output_batch, point_batch = data_arrays
+
+        if copy_batch:
+            output_batch = copy.deepcopy(output_batch)
+            point_batch = copy.deepcopy(point_batch)
+
+        input_batch = \
+            self._process_input_batch(input_batch, clean_input, copy_batch)
+
+        return input_batch, output_batch, point_batch
+
+    @staticmethod
+    def _pad_batch(data_arrays, count):
+        """An internal method to fill a partial batch with repeated points."""
+
+        input_batch, output_batch, point_batch = data_arrays
+
+        # Repeat the first count rows cyclically over the unused rows.
+        repeats = np.arange(count, len(output_batch)) % count
+        for data in input_batch.values():
+            data[count:] = data[repeats]
+        output_batch[count:] = output_batch[repeats]
+        point_batch[count:] = point_batch[repeats]
+
+    def __getstate__(self):
+
+        # Don't pickle the compiled dense predictor, which is recreated when
+        # it is next needed.
+        state = self.__dict__.copy()
+        state['_dense_predictor'] = None
 
-    def add_feature(self, feature_name, feature_function):
+        return state
+
+    def add_feature(self, feature_name, feature_function, margins=None):
         """Add a new feature to the extractor."""
 
-        # Add the function.
+        # Feature specifications are always extracted in batch form.
+        if isinstance(feature_function, Feature):
+            self.add_batch_feature(feature_name, feature_function,
+                                   margins=margins)
+            return
+
+        # Add the function, replacing any batch function of the same name.
         self.features[feature_name] = feature_function
+        self.batch_features.pop(feature_name, None)
+        self._set_margins(feature_name, margins)
 
         # Initialise the size as None.  Sizes are found by calling
         # self.find_feature_sizes().
         self.feature_sizes[feature_name] = None
 
+    def add_batch_feature(self, feature_name, batch_function,
+                          feature_size=None, margins=None):
+        """Add a new feature that extracts data for many points at once."""
+
+        # Add the batch function, along with a per-point form of it so that
+        # single point extraction keeps working.
+        self.batch_features[feature_name] = batch_function
+        self.features[feature_name] = _PointFunction(batch_function)
+
+        # Feature specifications declare their own size and margins.
+        if isinstance(batch_function, Feature):
+            if feature_size is None:
+                feature_size = batch_function.shape
+            if margins is None:
+                margins = batch_function.margins
+        self._set_margins(feature_name, margins)
+
+        # Use the size if it is known, otherwise it is found by calling
+        # self.find_feature_sizes().
+        if feature_size is not None:
+            feature_size = tuple(feature_size)
+        self.feature_sizes[feature_name] = feature_size
+
+    def _set_margins(self, feature_name, margins):
+        """An internal method to record the margins of a feature."""
+
+        if margins is not None:
+            margins = tuple(int(margin) for margin in margins)
+        self.feature_margins[feature_name] = margins
+
+    def _union_margins(self):
+        """An internal method to find the union of all known margins."""
+
+        margins = [0, 0, 0]
+        for feature_margins in self.feature_margins.values():
+            if feature_margins is not None:
+                margins = [max(pair) for pair in zip(margins, feature_margins)]
+
+        return margins
+
+    def valid_box(self, volume, bounds=None):
+        """
+        Get the box of points where all features with known margins work.
+
+        Args
+            volume (Volume): the volume to find the box for.
+            bounds (tuple): optional inclusive minimum and maximum indices of
+                a box to restrict the result to.
+
+        Returns
+            lows (list): the first index of the box along each axis.
+            highs (list): one past the last index of the box along each axis.
+
+        """
+
+        margins = self._union_margins()
+        lows = list(margins)
+        highs = [size - margin for size, margin in zip(volume.shape, margins)]
+
+        if bounds is not None:
+            lows = [max(low, start) for low, start in zip(lows, bounds[0])]
+            highs = [min(high, stop + 1)
+                     for high, stop in zip(highs, bounds[1])]
+
+        return lows, highs
+
+    def valid_mask(self, volume):
+        """
+        Get a mask of the points where all features with known margins work.
+
+        Args
+            volume (Volume): the volume to create the mask for.
+
+        Returns
+            mask (numpy.ndarray): a boolean array the same shape as the volume,
+                which is the volume eroded by the union of all feature margins.
+
+        Notes
+            The mask is the box returned by valid_box.  Prefer valid_box (or
+            a box shaped PointSet) where possible, since it doesn't create a
+            volume sized array.
+
+        """
+
+        lows, highs = self.valid_box(volume)
+
+        return PointSet(volume.shape, lows=lows, highs=highs).to_mask()
+
+    def valid_map(self, volume, point_map):
+        """
+        Restrict a point map to the points where all features are valid.
+
+        Args
+            volume (Volume): the volume the map belongs to.
+            point_map (PointSet/numpy.ndarray): a point set, or an array that
+                is the same size as the volume.
+
+        Returns
+            valid_point_map (PointSet): the points in point_map that lie
+                within the valid box (see valid_box).
+            discarded_count (int): the number of points that were removed.
+
+        """
+
+        point_map = as_point_set(point_map, volume.shape)
+        valid_point_map = point_map.intersect_box(*self.valid_box(volume))
+        discarded_count = len(point_map) - len(valid_point_map)
+
+        return valid_point_map, discarded_count
+
+    def _restrict_map(self, volume, point_map):
+        """An internal method to restrict a map and record the discards."""
+
+        valid_point_map, discarded_count = self.valid_map(volume, point_map)
+        self.discarded_points[volume.name] = discarded_count
+
+        return valid_point_map
+
+    def _record_discards(self, volume, discarded_count):
+        """An internal method to count points skipped during extraction."""
+
+        self.discarded_points[volume.name] = \
+            self.discarded_points.get(volume.name, 0) + discarded_count
+
+    def is_batch_capable(self):
+        """Check whether every feature can be extracted in batch form."""
+
+        return len(self.features) > 0 and \
+            all(name in self.batch_features for name in self.features)
+
     def find_feature_sizes(self, volume, point_map=None):
-        """Fill in the feature_sizes dictionary using a supplied volume."""
+        """
+        Fill in the feature_sizes dictionary using a supplied volume.
 
-        # If point_map is not supplied, then iterate over all points.
-        if point_map is None:
-            point_map = np.full(volume.shape, True, dtype='bool')
+        Notes
+            Sizes declared when features are added (including those of
+            feature specifications) are never searched for.  Any remaining
+            sizes are found by trying points of the map in turn, scanning it
+            a chunk at a time from the middle of the map outwards, so that the
+            search stops as soon as every size is known.  Found sizes are
+            kept, so this only does work once.
 
-        # Construct lists for iterating through all points.
-        points = zip(*np.nonzero(point_map))
+        """
 
-        # Loop through the points and attempt to extract data.  Some points
-        # (e.g. edge points for patches) will be invalid.
-        for point in points:
+        # Create a list of all features for which we don't have sizes.  If
+        # this list is empty, then there is nothing to do.
+        rem_features = [feature_name for feature_name, feature_size in
+                        self.feature_sizes.items() if feature_size is None]
+        if len(rem_features) == 0:
+            return
 
-            # Create a list of all features for which we don't have sizes.
-            rem_features = [feature_name for feature_name, feature_size in
-                            self.feature_sizes.items() if
-                            feature_size is None]
+        # If point_map is not supplied, then iterate over all points where
+        # features with known margins are valid.
+        if point_map is None:
+            lows, highs = self.valid_box(volume)
+            point_map = PointSet(volume.shape, lows=lows, highs=highs)
 
-            # If this list is empty, then stop.
-            if len(rem_features) == 0:
-                return
+        # Loop through the points and attempt to extract data.  Some points
+        # (e.g. edge points for patches) will be invalid.
+        for point in self._iterate_map_points(point_map):
 
-            # For each of these features, try the current point.
+            # For each of the remaining features, try the current point.
             for feature_name in rem_features:
                 try:
                     data = self.extract_point_feature(volume,
@@ -99,7 +348,28 @@ class Extractor:
                     continue
 
                 # Add the shape.
-                self.feature_sizes[feature_name] = data.shape
+                self.feature_sizes[feature_name] = np.shape(data)
+
+            # Stop once all sizes are known.
+            rem_features = [feature_name for feature_name in rem_features
+                            if self.feature_sizes[feature_name] is None]
+            if len(rem_features) == 0:
+                return
+
+    @staticmethod
+    def _iterate_map_points(point_map, chunk_size=2 ** 16):
+        """An internal generator of a map's points, found a chunk at a time."""
+
+        # Start from the middle of the map, where features are most likely to
+        # be valid, and wrap around to the beginning.
+        point_map = as_point_set(point_map)
+        point_count = len(point_map)
+        starts = list(range(0, point_count, chunk_size))
+        middle = len(starts) // 2
+        for start in starts[middle:] + starts[:middle]:
+            positions = np.arange(start, min(start + chunk_size, point_count))
+            for point in point_map.points(positions):
+                yield tuple(point)
 
     def extract_point_feature(self, volume, point, feature_name):
         """
@@ -142,17 +412,72 @@ class Extractor:
 
         return point_data
 
+    def extract_batch_features(self, volume, points, input_batch, start=0):
+        """
+        Extract data for all features from many points into an input batch.
+
+        Args
+            volume (Volume): the volume to extract from.
+            points (numpy.ndarray): an (N, 3) array of coordinates.
+            input_batch (dict): a dictionary of preallocated feature arrays.
+            start (int): the row of input_batch to start writing at.
+
+        Notes
+            All features must have batch functions.  A FeatureError is raised
+            if any feature is invalid at any of the points.
+
+        """
+
+        stop = start + len(points)
+        for feature_name, batch_function in self.batch_features.items():
+            batch_function(volume, points,
+                           input_batch[feature_name][start:stop])
+
+    def _valid_rows(self, volume, points):
+        """An internal method to find the points where all features work."""
+
+        valid = np.ones(len(points), dtype='bool')
+        for i, point in enumerate(points):
+            for batch_function in self.batch_features.values():
+                try:
+                    batch_function(volume, point[np.newaxis], None)
+                except FeatureError:
+                    valid[i] = False
+                    break
+
+        return valid
+
+    def _fill_batch(self, volume, points, input_batch, start):
+        """An internal method to extract the valid points of a chunk."""
+
+        # Try the whole chunk at once, and only screen individual points if
+        # some of them are invalid.
+        try:
+            self.extract_batch_features(volume, points, input_batch, start)
+        except FeatureError:
+            valid = self._valid_rows(volume, points)
+            self.extract_batch_features(volume, points[valid], input_batch,
+                                        start)
+            return valid
+
+        return np.ones(len(points), dtype='bool')
+
     def extract_from_map(self, volume, point_map, batch_size,
-                         clean_input=True):
+                         clean_input=True, copy_batches=True, ring_size=2):
         """
         Extracts data randomly from a specified map and volume.
 
         Args
             volume (Volume): the volume to extract from.
-            point_map (numpy.ndarray): an array that is the same size as the
-                volume.  Points corresponding to non-zero elements will be
-                included in the batch data.
+            point_map (PointSet/numpy.ndarray): the points to extract, or an
+                array that is the same size as the volume, whose non-zero
+                elements are the points.
             batch_size (int): the number of points to evaluate in a batch.
+            copy_batches (bool): whether to yield copies of the batches.  If
+                False, the yielded arrays are owned by the extractor (see
+                Notes).
+            ring_size (int): the number of sets of arrays to cycle through
+                when copy_batches is False.
 
         Returns
             input_batch (dict/numpy.ndarray): if there is more than one feature
@@ -167,39 +492,87 @@ class Extractor:
             Points are iterated over in a random fashion to provide even
             coverage of the entire map in each batch.
 
+            If copy_batches is False, no copies are made.  The yielded arrays
+            are views into a ring of ring_size preallocated sets of arrays,
+            so a yielded batch is only valid until ring_size further batches
+            have been requested (by default, it stays intact while the next
+            batch is in use, and is overwritten when the one after that is
+            extracted).  Copy any batch that needs to be kept for longer.
+
         """
 
-        # Get the indices of the points to extract.
-        map_indices = np.nonzero(point_map)
+        # Remove points where the features can't be extracted.
+        point_map = self._restrict_map(volume, point_map)
+
+        return self._extract_from_map(volume, point_map, batch_size,
+                                      clean_input, copy_batches, ring_size)
+
+    def _extract_from_map(self, volume, point_map, batch_size, clean_input,
+                          copy_batches=False, ring_size=1):
+        """An internal generator for extract_from_map (without restriction)."""
 
         # Get the number of points to extract.
-        point_count = map_indices[0].size
+        point_count = len(point_map)
 
-        # Create a permuted array for shuffling the indices and randomising the
-        # order in which the points are processed.
+        # Create a permuted array for shuffling the points and randomising the
+        # order in which they are processed.
         permutation = np.arange(point_count)
         np.random.shuffle(permutation)
 
-        # Shuffle the indices.
-        shuffled_indices = []
-        for indices in map_indices:
-            shuffled_indices.append(indices[permutation])
-
-        # Create a set of points for indexing.
-        point_set = tuple(zip(*shuffled_indices))
-
         # Make sure all feature sizes have been calculated.
         self.find_feature_sizes(volume, point_map=point_map)
 
-        # Initialise the arrays to return data in.
-        input_batch, output_batch, point_batch = \
-            self._create_data_arrays(batch_size)
+        # Initialise the arrays to return data in.  Copied batches only ever
+        # need one set of arrays.
+        ring = self._create_data_ring(batch_size,
+                                      1 if copy_batches else ring_size)
+        ring_index = 0
+        input_batch, output_batch, point_batch = ring[ring_index]
 
         # Initialise a counter for the number of points successfully extracted.
         count = 0
 
+        # If possible, extract whole chunks of points at once.
+        if self.is_batch_capable():
+            position = 0
+            while position < point_count:
+
+                # Take enough points to fill the current batch, and extract
+                # those that are valid.
+                start = count % batch_size
+                chunk = point_map.points(
+                    permutation[position:position + batch_size - start])
+                position += len(chunk)
+                valid = self._fill_batch(volume, chunk, input_batch, start)
+                chunk = chunk[valid]
+                if len(chunk) < len(valid):
+                    self._record_discards(volume, len(valid) - len(chunk))
+
+                # Copy the remaining data into the return arrays.
+                stop = start + len(chunk)
+                output_batch[start:stop] = volume.seg_data[tuple(chunk.T)]
+                point_batch[start:stop] = chunk
+
+                # Increment the counter.
+                count += len(chunk)
+
+                if len(chunk) > 0 and count % batch_size == 0:
+                    yield self._process_batch(ring[ring_index], clean_input,
+                                              copy_batches)
+
+                    # Move on to the next set of arrays.
+                    ring_index = (ring_index + 1) % len(ring)
+                    input_batch, output_batch, point_batch = ring[ring_index]
+
+            if count % batch_size != 0:
+                self._pad_batch(ring[ring_index], count % batch_size)
+                yield self._process_batch(ring[ring_index], clean_input,
+                                          copy_batches)
+
+            return
+
         # Loop through until there are no valid points left.
-        for point in point_set:
+        for point in map(tuple, point_map.points(permutation)):
 
             # Try to get the data (may raise a FeatureError due to a feature
             # function being invalid at the point.
@@ -208,6 +581,7 @@ class Extractor:
 
             # Skip to the next point if the feature was invalid.
             except FeatureError:
+                self._record_discards(volume, 1)
                 continue
 
             # Copy the data into the return arrays.
@@ -220,29 +594,36 @@ class Extractor:
             count += 1
 
             if count % batch_size == 0:
-                yield self._process_input_batch(input_batch, clean_input), \
-                      copy.deepcopy(output_batch), \
-                      copy.deepcopy(point_batch)
+                yield self._process_batch(ring[ring_index], clean_input,
+                                          copy_batches)
+
+                # Move on to the next set of arrays.
+                ring_index = (ring_index + 1) % len(ring)
+                input_batch, output_batch, point_batch = ring[ring_index]
 
         # If any new data has been added, yield the final set of points before
         # stopping.  This means that all valid points are extracted from, but
-        # some points (in the worst case batch_size - 1) will be repeated.
-        # This isn't really a problem for either prediction or training.
+        # some points (in the worst case batch_size - 1) will be repeated to
+        # fill the batch.  This isn't really a problem for either prediction
+        # or training.
         if count % batch_size != 0:
-            yield self._process_input_batch(input_batch, clean_input), \
-                  copy.deepcopy(output_batch), \
-                  copy.deepcopy(point_batch)
+            self._pad_batch(ring[ring_index], count % batch_size)
+            yield self._process_batch(ring[ring_index], clean_input,
+                                      copy_batches)
 
-    def iterate_single(self, volume, point_map, batch_size, clean_input=True):
+    def iterate_single(self, volume, point_map, batch_size, clean_input=True,
+                       copy_batches=True, ring_size=2):
         """
         Extract batches of data from a volume randomly, with even coverage.
 
         Args
             volume (Volume): the volume to extract from.
-            point_map (numpy.ndarray): an array that is the same size as the
-                volume.  Points corresponding to non-zero elements will be
-                included in the batch data.
+            point_map (PointSet/numpy.ndarray): the points to extract (as for
+                extract_from_map).
             batch_size (int): the number of points to evaluate in a batch.
+            copy_batches (bool): whether to yield copies of the batches.
+            ring_size (int): the number of sets of arrays to cycle through
+                when copy_batches is False.
 
         Returns
             input_batch (dict): a dictionary of input data.  The first
@@ -257,15 +638,29 @@ class Extractor:
             3/4 of the points being trained on are positive, then each batch
             will produce 3/4 * batch_size positive points.
 
+            Batches yielded with copy_batches set to False have the same
+            lifetime as those of extract_from_map().
+
         """
 
-        # Create an array containing individual maps for each category
-        # (currently only pectoral/non-pectoral).
-        map_types = [np.logical_and(point_map, volume.seg_data == 1),
-                     np.logical_and(point_map, volume.seg_data == 0)]
+        # Remove points where the features can't be extracted.
+        point_map = self._restrict_map(volume, point_map)
+
+        return self._iterate_single(volume, point_map, batch_size, clean_input,
+                                    copy_batches, ring_size)
+
+    def _iterate_single(self, volume, point_map, batch_size, clean_input,
+                        copy_batches=False, ring_size=1):
+        """An internal generator for iterate_single (without restriction)."""
+
+        # Create individual maps for each category (currently only
+        # pectoral/non-pectoral).
+        labels = point_map.values(volume.seg_data)
+        map_types = [point_map.where(labels == 1),
+                     point_map.where(labels == 0)]
 
         # Create lists of statistics for each map type.
-        point_counts = [np.sum(map_type) for map_type in map_types]
+        point_counts = [len(map_type) for map_type in map_types]
         point_ratios = [point_count / sum(point_counts)
                         for point_count in point_counts]
         sub_batch_sizes = [int(point_ratio * batch_size)
@@ -278,12 +673,16 @@ class Extractor:
         self.find_feature_sizes(volume, point_map=point_map)
 
         # Initialise the arrays to return data in.
-        input_batch, output_batch, point_batch = \
-            self._create_data_arrays(batch_size)
+        ring = self._create_data_ring(batch_size,
+                                      1 if copy_batches else ring_size)
+        ring_index = 0
+        input_batch, output_batch, point_batch = ring[ring_index]
 
         # Create the individual generators for extracting data using each map.
-        gens = [self.extract_from_map(volume, map_types[i], sub_batch_sizes[i],
-                                      clean_input=False)
+        # Their batches are copied into the return arrays straight away, so
+        # they don't need to be copied when they are yielded.
+        gens = [self._extract_from_map(volume, map_types[i],
+                                       sub_batch_sizes[i], False)
                 for i in range(len(map_types))]
 
         # Create an array to use for insertion of individual sub_batches into
@@ -313,19 +712,30 @@ class Extractor:
             # If the end of a generator has not yet been reached, return the
             # data.
             if keep_generating:
-                yield self._process_input_batch(input_batch, clean_input), \
-                      copy.deepcopy(output_batch), \
-                      copy.deepcopy(point_batch)
+                yield self._process_batch(ring[ring_index], clean_input,
+                                          copy_batches)
+
+                # Move on to the next set of arrays.
+                ring_index = (ring_index + 1) % len(ring)
+                input_batch, output_batch, point_batch = ring[ring_index]
 
     def iterate_multiple(self, volumes, point_maps, batch_size,
-                         clean_input=True):
+                         clean_input=True, copy_batches=True, ring_size=2,
+                         num_workers=None):
         """
         Extract data from a list of volumes in a balanced and random way.
 
         Args
             volumes (list): the list of volumes to extract from.
-            training_maps (list): a list of maps to use for extraction.
+            training_maps (list): a list of maps (PointSets or arrays) to use
+                for extraction.
             batch_size (int): the size of the return batches.
+            copy_batches (bool): whether to yield copies of the batches.
+            ring_size (int): the number of sets of arrays to cycle through
+                when copy_batches is False.
+            num_workers (int): if given, the volumes are shared between this
+                many worker processes, which extract their sub batches in
+                parallel.
 
         Returns
             input_batch (dict): a dictionary of input data.  The first
@@ -333,15 +743,28 @@ class Extractor:
             output_batch(numpy.ndarray): an array of output data.  This is
                 simply a binary array indicating how each point is classified.
 
+        Notes
+            Batches yielded with copy_batches set to False have the same
+            lifetime as those of extract_from_map().
+
+            Worker processes are forked, so they inherit the volumes, maps and
+            features without pickling them.  Each worker is seeded from the
+            global numpy random state, and the batches are assembled in the
+            same proportions as when extracting serially.
+
         """
 
         # Check the volumes and maps data is valid.
         if len(volumes) != len(point_maps):
             raise Exception('Each volume must have a corresponding point map.')
 
+        # Remove points where the features can't be extracted.
+        point_maps = [self._restrict_map(volume, point_map)
+                      for volume, point_map in zip(volumes, point_maps)]
+
         # Get the sub_batch_sizes for each volume based on how many points are
         # being extracted from it.
-        point_counts = [np.sum(point_map) for point_map in point_maps]
+        point_counts = [len(point_map) for point_map in point_maps]
         point_ratios = [point_count / sum(point_counts)
                         for point_count in point_counts]
         sub_batch_sizes = [int(point_ratio * batch_size)
@@ -352,29 +775,27 @@ class Extractor:
             self.find_feature_sizes(volume, point_map=point_map)
 
         # Initialise the arrays to return data in.
-        input_batch, output_batch, point_batch = \
-            self._create_data_arrays(batch_size)
-
-        # Create the generators for each volume.
-        gens = [self.iterate_single(volumes[i], point_maps[i],
-                                    sub_batch_sizes[i], clean_input=False)
-                for i in range(len(volumes))]
+        ring = self._create_data_ring(batch_size,
+                                      1 if copy_batches else ring_size)
+        ring_index = 0
+        input_batch, output_batch, _ = ring[ring_index]
+
+        # Create the source of sub batches for each volume, either in this
+        # process or spread across worker processes.
+        if num_workers is None:
+            rounds = self._serial_rounds(volumes, point_maps, sub_batch_sizes)
+        else:
+            rounds = self._parallel_rounds(volumes, point_maps,
+                                           sub_batch_sizes, num_workers)
 
         # Create an array to use for insertion of individual sub_batches into
         # the returned batches.
         ins_indices = np.cumsum([0] + sub_batch_sizes)
 
-        # Use the generators until they are exhausted.
-        keep_generating = True
-        while keep_generating:
-            for i in range(len(gens)):
-
-                # Try to get the next sub batch.
-                try:
-                    sub_input_batch, sub_output_batch, _ = next(gens[i])
-                except StopIteration:
-                    keep_generating = False
-                    break
+        # Use the sub batches until any volume's generator is exhausted.
+        for sub_batches in rounds:
+            for i, (sub_input_batch, sub_output_batch) in \
+                    enumerate(sub_batches):
 
                 # Insert the data into the return array.
                 ins_slice = slice(ins_indices[i], ins_indices[i + 1])
@@ -382,43 +803,1110 @@ class Extractor:
                     input_batch[name][ins_slice] = data
                 output_batch[ins_slice] = sub_output_batch
 
-            # If the end of a generator has not yet been reached, return the
-            # data.
-            if keep_generating:
+            yield self._process_batch(ring[ring_index], clean_input,
+                                      copy_batches)[:2]
 
-                yield self._process_input_batch(input_batch, clean_input),\
-                      copy.deepcopy(output_batch)
+            # Move on to the next set of arrays.
+            ring_index = (ring_index + 1) % len(ring)
+            input_batch, output_batch, _ = ring[ring_index]
 
-    def predict(self, net, volume, batch_size, bounds=None):
-        """Return a copy of the supplied volume with predicted segmentation."""
+    def _serial_rounds(self, volumes, point_maps, sub_batch_sizes):
+        """An internal generator of lists of sub batches, one per volume."""
 
-        # Preallocate the array for the predicted segmentation.
-        predicted_seg = np.zeros(volume.shape, dtype='float32')
+        # Create the generators for each volume.
+        gens = [self._iterate_single(volumes[i], point_maps[i],
+                                     sub_batch_sizes[i], False)
+                for i in range(len(volumes))]
 
-        # Create the map defining the points to predict on, and restrict these
-        # points to be within the defined bounds if necessary.
-        if bounds is None:
-            point_map = np.ones(volume.shape, dtype='bool')
+        # Use the generators until any of them are exhausted.
+        while True:
+            sub_batches = []
+            for gen in gens:
+
+                # Try to get the next sub batch.
+                try:
+                    sub_input_batch, sub_output_batch, _ = next(gen)
+                except StopIteration:
+                    return
+
+                sub_batches.append((sub_input_batch, sub_output_batch))
+
+            yield sub_batches
+
+    def _parallel_rounds(self, volumes, point_maps, sub_batch_sizes,
+                         num_workers):
+        """An internal generator of sub batches from worker processes."""
+
+        # Forking lets the workers inherit the extractor and the volumes.
+        if hasattr(multiprocessing, 'get_context'):
+            context = multiprocessing.get_context('fork')
         else:
-            point_map = np.zeros(volume.shape, dtype='bool')
-            bound_slices = [slice(start, stop + 1)
-                            for start, stop in zip(*bounds)]
-            point_map[bound_slices] = True
+            context = multiprocessing
+
+        # Share out the volumes so that each worker extracts a similar number
+        # of points per batch, largest sub batches first.
+        assignments = [[] for _ in range(num_workers)]
+        loads = [0] * num_workers
+        order = sorted(range(len(volumes)), key=lambda i: -sub_batch_sizes[i])
+        for i in order:
+            worker_index = loads.index(min(loads))
+            assignments[worker_index].append(i)
+            loads[worker_index] += sub_batch_sizes[i]
+        assignments = [sorted(assignment) for assignment in assignments
+                       if len(assignment) > 0]
+
+        # Start the workers, each with its own bounded queue.
+        seeds = np.random.randint(2 ** 31 - 1, size=len(assignments))
+        result_queues = []
+        workers = []
+        for assignment, seed in zip(assignments, seeds):
+            result_queue = context.Queue(maxsize=2)
+            worker = context.Process(
+                target=self._produce_rounds,
+                args=(volumes, point_maps, sub_batch_sizes, assignment, seed,
+                      result_queue)
+            )
+            worker.daemon = True
+            worker.start()
+            result_queues.append(result_queue)
+            workers.append(worker)
+
+        try:
+            while True:
+
+                # Collect one round of sub batches from every worker, and put
+                # them back into volume order.
+                sub_batches = [None] * len(volumes)
+                for assignment, result_queue in zip(assignments,
+                                                    result_queues):
+                    kind, value = result_queue.get()
+                    if kind == 'error':
+                        raise Exception('Extraction worker failed.\n' + value)
+
+                    # Keep the worker's counts of discarded points.
+                    value, discarded_points = value
+                    self.discarded_points.update(discarded_points)
+                    if kind == 'stop':
+                        return
+                    for i, sub_batch in zip(assignment, value):
+                        sub_batches[i] = sub_batch
+
+                yield sub_batches
+
+        finally:
+            for worker in workers:
+                worker.terminate()
+                worker.join()
+
+    def _produce_rounds(self, volumes, point_maps, sub_batch_sizes,
+                        assignment, seed, result_queue):
+        """An internal method to extract sub batches in a worker process."""
+
+        np.random.seed(seed)
+
+        try:
+            gens = [self._iterate_single(volumes[i], point_maps[i],
+                                         sub_batch_sizes[i], False)
+                    for i in assignment]
+
+            # Send the counts of discarded points along with the batches.
+            def discards():
+                return dict((volumes[i].name,
+                             self.discarded_points.get(volumes[i].name, 0))
+                            for i in assignment)
+
+            while True:
+                sub_batches = []
+                for gen in gens:
+                    try:
+                        sub_input_batch, sub_output_batch, _ = next(gen)
+                    except StopIteration:
+                        result_queue.put(('stop', (None, discards())))
+                        return
+
+                    # The queue pickles its items later, so copy them before
+                    # the generator reuses its arrays.
+                    sub_batches.append((copy.deepcopy(sub_input_batch),
+                                        copy.deepcopy(sub_output_batch)))
+
+                result_queue.put(('batch', (sub_batches, discards())))
+
+        except Exception:
+            result_queue.put(('error', traceback.format_exc()))
+
+    def extract_from_box(self, volume, batch_size, bounds=None,
+                         clean_input=True, copy_batches=True, ring_size=2,
+                         order='C'):
+        """
+        Extracts data from every valid point of a box, in raster order.
+
+        Args
+            volume (Volume): the volume to extract from.
+            batch_size (int): the number of points to evaluate in a batch.
+            bounds (tuple): optional inclusive minimum and maximum indices of
+                the box to extract from.  Defaults to the whole volume.
+            copy_batches (bool): whether to yield copies of the batches (see
+                extract_from_map).
+            ring_size (int): the number of sets of arrays to cycle through
+                when copy_batches is False.
+            order (str): the order to walk the box in, 'C' (the last axis
+                varies fastest) or 'F' (the first axis varies fastest).
+
+        Returns
+            input_batch (dict/numpy.ndarray): as for extract_from_map.
+            point_batch (numpy.ndarray): an array of points that were used to
+                generate the data.
+            box_positions (slice/numpy.ndarray): the positions of the points
+                in the box returned by valid_box (flattened in order), one
+                for each of the first len(box_positions) rows of the batch.
+                This is a slice whenever the batch holds a contiguous run of
+                the box.
+
+        Notes
+            The box is restricted by valid_box and walked in raster order,
+            with the points of each batch generated from the box shape, so
+            no volume sized map is created and consecutive batches
+            read neighbouring data.  Each batch covers the next batch_size
+            positions of the box, and any rows left over (from invalid
+            points, or the end of the box) are filled by repeating points.
+
+        """
+
+        lows, highs = self.valid_box(volume, bounds)
+        box_shape = [max(high - low, 0) for low, high in zip(lows, highs)]
+        box_size = int(np.prod(box_shape))
 
-        # Iterate through to predict values, and record.
-        for input_batch, _, point_batch in \
-                self.extract_from_map(volume, point_map, batch_size):
+        # Generate the points of each part of the box as it is needed.
+        def box_chunks():
+            for start in range(0, box_size, batch_size):
+                positions = np.arange(start, min(start + batch_size,
+                                                 box_size))
+                points = np.array(np.unravel_index(positions, box_shape,
+                                                   order=order)).T
+                yield points + np.array(lows), start
 
-            # Predict and assign the values to the new volume.
-            predicted_data = net.predict(input_batch)
-            point_indices = tuple(zip(*point_batch))
-            predicted_seg[point_indices] = predicted_data.reshape(batch_size)
+        return self._extract_chunks(volume, box_chunks(), batch_size,
+                                    clean_input, copy_batches, ring_size)
+
+    def extract_from_points(self, volume, points, batch_size,
+                            clean_input=True, copy_batches=True, ring_size=2):
+        """
+        Extracts data from a list of points, in the order given.
+
+        Args
+            volume (Volume): the volume to extract from.
+            points (numpy.ndarray): an (N, 3) array of coordinates.
+            batch_size (int): the number of points to evaluate in a batch.
+            copy_batches (bool): whether to yield copies of the batches (see
+                extract_from_map).
+            ring_size (int): the number of sets of arrays to cycle through
+                when copy_batches is False.
+
+        Returns
+            input_batch (dict/numpy.ndarray): as for extract_from_map.
+            point_batch (numpy.ndarray): an array of points that were used to
+                generate the data.
+            rows (slice/numpy.ndarray): the rows of points that were
+                extracted, one for each of the first len(rows) rows of the
+                batch (as box_positions in extract_from_box).
+
+        """
+
+        points = np.asarray(points, dtype='int64').reshape(-1, 3)
+        chunks = ((points[start:start + batch_size], start)
+                  for start in range(0, len(points), batch_size))
+
+        return self._extract_chunks(volume, chunks, batch_size, clean_input,
+                                    copy_batches, ring_size)
+
+    def _extract_chunks(self, volume, chunks, batch_size, clean_input,
+                        copy_batches, ring_size):
+        """An internal generator to extract batches from chunks of points."""
+
+        # Make sure all feature sizes have been calculated.
+        self.find_feature_sizes(volume)
+
+        # Initialise the arrays to return data in.
+        ring = self._create_data_ring(batch_size,
+                                      1 if copy_batches else ring_size)
+        ring_index = 0
+
+        for points, start in chunks:
+            input_batch, output_batch, point_batch = ring[ring_index]
+
+            # Extract the valid points.
+            valid = self._extract_rows(volume, points, input_batch, 0)
+
+            # Find where the extracted points came from.
+            count = int(np.count_nonzero(valid))
+            if count == 0:
+                continue
+            if count == len(points):
+                positions = slice(start, start + count)
+            else:
+                positions = start + np.flatnonzero(valid)
+
+            point_batch[:count] = points[valid]
+            output_batch[:count] = 0
+            if count < batch_size:
+                self._pad_batch(ring[ring_index], count)
+
+            input_batch, _, point_batch = self._process_batch(
+                ring[ring_index], clean_input, copy_batches)
+            yield input_batch, point_batch, positions
+
+            # Move on to the next set of arrays.
+            ring_index = (ring_index + 1) % len(ring)
+
+    def _extract_rows(self, volume, points, input_batch, start):
+        """An internal method to extract the valid points of a chunk."""
+
+        if self.is_batch_capable():
+            return self._fill_batch(volume, points, input_batch, start)
+
+        # Extract point by point, skipping invalid points.
+        valid = np.ones(len(points), dtype='bool')
+        row = start
+        for i, point in enumerate(points):
+            try:
+                point_data = self.extract_point_features(volume, tuple(point))
+            except FeatureError:
+                valid[i] = False
+                continue
+            for name, data in point_data.items():
+                input_batch[name][row] = data
+            row += 1
+
+        return valid
+
+    def predict(self, net, volume, batch_size, bounds=None, dense=False,
+                slab_size=16, coarse_stride=None, uncertainty=0.2,
+                cascade=None, sink=None, pipeline_depth=None, point_map=None):
+        """
+        Return a copy of the supplied volume with predicted segmentation.
+
+        Notes
+            Points are predicted on in raster order within the box returned
+            by valid_box (see extract_from_box), so no volume sized map is
+            built and the results are written back contiguously.  Points
+            where the features are invalid are left as zero.
+
+            If dense is True, the convolutional branches of the net are run
+            over whole slices rather than patch by patch (see
+            DensePredictor).  The compiled dense functions are kept for the
+            most recent net, so predicting on many volumes only compiles them
+            once.  Dense prediction always evaluates every point of the box,
+            so it can't be combined with coarse_stride, cascade or
+            pipeline_depth.
+
+            If coarse_stride is given, the net is first evaluated on a grid
+            with that spacing, and the grid is then repeatedly halved (down
+            to every point).  At each step the new grid points are linearly
+            interpolated from the old grid, and the net is only evaluated
+            where the interpolated probability is within uncertainty of 0.5,
+            or where the surrounding old grid points straddle 0.5.  The
+            last step (to every point) is done a slab at a time along the
+            sink's slice_axis, and each slab is written as it is finished.
+            The number of net evaluations made, and saved compared with
+            predicting on every point, is recorded in network_evaluations.
+
+            If a fitted Cascade is given, points that it rejects are never
+            extracted or passed to the net, and are given the cascade's prior
+            probability instead.  Without coarse_stride, the box is screened
+            and predicted on a slab at a time along the sink's slice_axis,
+            and each slab is written as it is finished.
+
+            The probabilities are written into sink (an ArraySink by
+            default), which becomes the seg_data of the returned volume.
+            Raster order, cascade and coarse to fine prediction write the box
+            a slice or slab (along the sink's slice_axis) at a time as it is
+            completed, with raster order walking the box in the order the
+            sink stores its data.  So a NiftiSink or NpySink streams them to
+            disk without a box sized array in memory.  Dense prediction
+            writes its slabs (along the first axis) directly into the sink's
+            data, and prediction on a sparse point map holds the points and
+            predictions of the whole map before writing them.
+
+            If pipeline_depth is given, batches are extracted on a worker
+            thread while the net evaluates earlier ones, with up to
+            pipeline_depth batches waiting (see Prefetcher).  The time spent
+            in each stage is recorded in prediction_times.
+
+            If point_map is given (as a PointSet or a map array), only its
+            points within bounds are predicted on, and the rest of the sink
+            is left as it is.  A box shaped PointSet is predicted on as a box,
+            as if it had been given as bounds.
+
+        """
+
+        if dense:
+            for name, value in [('coarse_stride', coarse_stride),
+                                ('cascade', cascade),
+                                ('pipeline_depth', pipeline_depth)]:
+                if value is not None:
+                    raise Exception('Dense prediction can not be combined '
+                                    'with ' + name + '.')
+
+        if sink is None:
+            sink = ArraySink(volume.shape)
+
+        # Restrict the point map to the valid box, and treat boxes as bounds.
+        if point_map is not None:
+            point_map = as_point_set(point_map, volume.shape).intersect_box(
+                *self.valid_box(volume, bounds))
+            if point_map.is_box:
+                bounds = (point_map.lows,
+                          [high - 1 for high in point_map.highs])
+                point_map = None
+            elif dense:
+                raise Exception('Dense prediction can only predict on a '
+                                'box, not on a sparse point map.')
+
+        # Predict on the points of a sparse map, screening them with the
+        # cascade if there is one.
+        if point_map is not None:
+            runner = _NetRunner(net, pipeline_depth)
+            points = point_map.points()
+            predicted, evaluations = self._predict_screened(
+                runner, volume, points, batch_size, cascade)
+            sink.write_points(points, predicted)
+            self.network_evaluations[volume.name] = {
+                'evaluations': evaluations,
+                'saved': len(points) - evaluations
+            }
+            self.prediction_times = runner.times
+
+        # Use dense prediction if required.
+        elif dense:
+            predictor = self._get_dense_predictor(net, slab_size)
+            predictor.predict(volume, batch_size, bounds=bounds,
+                              out=sink.data)
+
+        else:
+            runner = _NetRunner(net, pipeline_depth)
+            self._predict_box(runner, volume, batch_size, bounds,
+                              coarse_stride, uncertainty, cascade, sink)
+            self.prediction_times = runner.times
+        sink.flush()
 
         return Volume(
             volume.name,
             volume.header,
             volume.affine,
             volume.mri_data,
-            predicted_seg,
+            sink.data,
             copy.deepcopy(volume.landmarks)
         )
+
+    def _predict_box(self, runner, volume, batch_size, bounds, coarse_stride,
+                     uncertainty, cascade, sink):
+        """An internal method to predict on the valid box into a sink."""
+
+        lows, highs = self.valid_box(volume, bounds)
+        box_shape = [max(high - low, 0) for low, high in zip(lows, highs)]
+        box_size = int(np.prod(box_shape))
+
+        # Each way of predicting writes to the sink as it goes.
+        if coarse_stride is not None and coarse_stride > 1 and box_size > 0:
+            evaluations = self._predict_adaptive(
+                runner, volume, batch_size, lows, box_shape, coarse_stride,
+                uncertainty, cascade, sink)
+
+        # Screen the points of the box with the cascade if required, and
+        # only predict on those that are accepted.
+        elif cascade is not None:
+            evaluations = self._predict_cascade(runner, volume, batch_size,
+                                                lows, box_shape, cascade,
+                                                sink)
+
+        # Otherwise, predict on the valid box in raster order.
+        else:
+            evaluations = self._predict_raster(runner, volume, batch_size,
+                                               bounds, lows, box_shape, sink)
+
+        # Record how much work was done.
+        self.network_evaluations[volume.name] = {
+            'evaluations': evaluations,
+            'saved': box_size - evaluations
+        }
+
+    def _predict_cascade(self, runner, volume, batch_size, lows, box_shape,
+                         cascade, sink):
+        """An internal method to predict on the points a cascade accepts."""
+
+        # Screen and predict a slab at a time, along the slowest axis of the
+        # sink, and write each slab as soon as it is finished.
+        evaluations = 0
+        for slab_lows, slab_shape in _box_slabs(lows, box_shape,
+                                                sink.slice_axis):
+            slab_highs = [low + size for low, size in
+                          zip(slab_lows, slab_shape)]
+            slab_output = np.full(slab_shape, cascade.prior, dtype='float32')
+            accepted = cascade.accept_box(volume, slab_lows, slab_highs)
+            points = np.argwhere(accepted) + np.array(slab_lows)
+            slab_output[accepted] = self._predict_points(runner, volume,
+                                                         points, batch_size)
+            sink.write_box(slab_lows, slab_output)
+            evaluations += len(points)
+
+        return evaluations
+
+    def _predict_raster(self, runner, volume, batch_size, bounds, lows,
+                        box_shape, sink):
+        """An internal method to stream raster order predictions to a sink."""
+
+        # Walk the box in the order the sink stores its data, so that each
+        # finished slice is a contiguous part of it.
+        writer = _SliceWriter(sink, lows, box_shape)
+        evaluations = 0
+        batches = self.extract_from_box(volume, batch_size, bounds=bounds,
+                                        copy_batches=False,
+                                        ring_size=runner.ring_size,
+                                        order=writer.order)
+        for predicted_data, _, box_positions in runner.evaluate(batches):
+            if isinstance(box_positions, slice):
+                box_positions = np.arange(box_positions.start,
+                                          box_positions.stop)
+            writer.write(box_positions,
+                         predicted_data[:len(box_positions)])
+            evaluations += len(box_positions)
+        writer.close()
+
+        return evaluations
+
+    def _predict_points(self, runner, volume, points, batch_size):
+        """An internal method to predict on a list of points."""
+
+        predicted = np.zeros(len(points), dtype='float32')
+        batches = self.extract_from_points(volume, points, batch_size,
+                                           copy_batches=False,
+                                           ring_size=runner.ring_size)
+        for predicted_data, _, rows in runner.evaluate(batches):
+            count = predicted[rows].size
+            predicted[rows] = predicted_data[:count]
+
+        return predicted
+
+    def _predict_screened(self, runner, volume, points, batch_size, cascade):
+        """An internal method to predict on the points a cascade accepts."""
+
+        if cascade is None:
+            return self._predict_points(runner, volume, points,
+                                        batch_size), len(points)
+
+        predicted = np.full(len(points), cascade.prior, dtype='float32')
+        accepted = cascade.accept(volume, points)
+        predicted[accepted] = self._predict_points(runner, volume,
+                                                   points[accepted],
+                                                   batch_size)
+
+        return predicted, int(np.count_nonzero(accepted))
+
+    def _predict_adaptive(self, runner, volume, batch_size, lows, box_shape,
+                          coarse_stride, uncertainty, cascade, sink):
+        """An internal method to predict coarse to fine over a box."""
+
+        # Evaluate the net on every point of the coarsest grid.
+        stride = coarse_stride
+        grid = [_grid_coordinates(size, stride) for size in box_shape]
+        points = _grid_points(grid, np.ones([len(coordinates) for coordinates
+                                             in grid], dtype='bool'), lows)
+        values, evaluations = self._predict_screened(runner, volume, points,
+                                                     batch_size, cascade)
+        values = values.reshape([len(coordinates) for coordinates in grid])
+
+        # Halve the stride where possible, so each finer grid contains the
+        # one before it, down to the last grid before every point.
+        stride = stride // 2 if stride % 2 == 0 else 1
+        while stride > 1:
+            fine_grid = [_grid_coordinates(size, stride) for size in box_shape]
+            values, count = self._refine_level(
+                runner, volume, batch_size, values, grid, fine_grid, lows,
+                uncertainty, cascade)
+            evaluations += count
+            grid = fine_grid
+            stride = stride // 2 if stride % 2 == 0 else 1
+
+        # Refine to every point a slab at a time, along the slowest axis of
+        # the sink, and write each slab as soon as it is finished.
+        axis = sink.slice_axis
+        for slab_lows, slab_shape in _box_slabs(lows, box_shape, axis):
+            fine_grid = [np.arange(size) for size in box_shape]
+            fine_grid[axis] = np.arange(slab_shape[axis]) + \
+                slab_lows[axis] - lows[axis]
+
+            # Only the cells of the grid around the slab are needed.
+            start, stop = _grid_cells(grid[axis], fine_grid[axis])
+            cell_grid = list(grid)
+            cell_grid[axis] = grid[axis][start:stop]
+            cell_values = values[(slice(None),) * axis + (slice(start, stop),)]
+
+            slab_values, count = self._refine_level(
+                runner, volume, batch_size, cell_values, cell_grid, fine_grid,
+                lows, uncertainty, cascade)
+            evaluations += count
+            sink.write_box(slab_lows, slab_values)
+
+        return evaluations
+
+    def _refine_level(self, runner, volume, batch_size, values, grid,
+                      fine_grid, lows, uncertainty, cascade):
+        """An internal method to refine grid values onto a finer grid."""
+
+        # Interpolate, and find the new points near the boundary.
+        estimates, straddles = _refine_grid(values, grid, fine_grid)
+        needed = straddles | (np.abs(estimates - 0.5) < uncertainty)
+        needed[np.ix_(*[np.flatnonzero(np.in1d(fine_coordinates, coordinates))
+                        for fine_coordinates, coordinates in
+                        zip(fine_grid, grid)])] = False
+
+        # Evaluate the net at those points only.
+        points = _grid_points(fine_grid, needed, lows)
+        estimates[needed], count = self._predict_screened(
+            runner, volume, points, batch_size, cascade)
+
+        return estimates, count
+
+    def predict_multiple(self, net, volumes, batch_size, bounds=None,
+                         sinks=None, pipeline_depth=None):
+        """
+        Predict on several volumes, packing their points into shared batches.
+
+        Args
+            net (nolearn.lasagne.NeuralNet): the net to predict with.
+            volumes (list): the volumes to predict on.
+            batch_size (int): the number of points to evaluate in a batch.
+            bounds (list): optional bounds (as for predict) for each volume,
+                or None for the whole volume.
+            sinks (list): optional sinks for each volume (see predict).
+            pipeline_depth (int): the number of batches to extract ahead of
+                the net on a worker thread (see predict), or None to
+                extract them in turn.
+
+        Returns
+            predicted_volumes (list): a copy of each volume, with the
+                predicted segmentation as its seg_data.
+
+        Notes
+            Each volume's valid box is walked in raster order, and a batch
+            continues into the next volume when one runs out, so every
+            batch is full apart from the very last one, which is passed to
+            the net at its actual size rather than being padded with
+            repeated points.  The results are streamed into each volume's
+            sink as in predict.
+
+        """
+
+        if bounds is None:
+            bounds = [None] * len(volumes)
+        if sinks is None:
+            sinks = [ArraySink(volume.shape) for volume in volumes]
+
+        # Find the box to predict on in each volume.
+        boxes = []
+        writers = []
+        for volume, volume_bounds, sink in zip(volumes, bounds, sinks):
+            lows, highs = self.valid_box(volume, volume_bounds)
+            box_shape = [max(high - low, 0) for low, high in zip(lows, highs)]
+            boxes.append((lows, box_shape))
+            writers.append(_SliceWriter(sink, lows, box_shape))
+
+        # Predict, and send the results for each row to its volume.
+        runner = _NetRunner(net, pipeline_depth)
+        evaluations = [0] * len(volumes)
+        batches = self._packed_batches(volumes, boxes, batch_size,
+                                       runner.ring_size,
+                                       [writer.order for writer in writers])
+        for predicted_data, volume_indices, box_positions in \
+                runner.evaluate(batches):
+            for volume_index in np.unique(volume_indices):
+                rows = volume_indices == volume_index
+                writers[volume_index].write(box_positions[rows],
+                                            predicted_data[rows])
+                evaluations[volume_index] += int(np.count_nonzero(rows))
+
+        self.prediction_times = runner.times
+
+        predicted_volumes = []
+        for volume, (_, box_shape), writer, sink, volume_evaluations in \
+                zip(volumes, boxes, writers, sinks, evaluations):
+            writer.close()
+            sink.flush()
+            self.network_evaluations[volume.name] = {
+                'evaluations': volume_evaluations,
+                'saved': int(np.prod(box_shape)) - volume_evaluations
+            }
+            predicted_volumes.append(Volume(
+                volume.name,
+                volume.header,
+                volume.affine,
+                volume.mri_data,
+                sink.data,
+                copy.deepcopy(volume.landmarks)
+            ))
+
+        return predicted_volumes
+
+    def _packed_batches(self, volumes, boxes, batch_size, ring_size=1,
+                        orders=None):
+        """
+        An internal generator of batches packed from the boxes of volumes.
+
+        Yields the input batch, the index of the volume that each row came
+        from and each row's position in the box of that volume, flattened in
+        its order in orders (C order by default).
+        The arrays are reused from a ring of ring_size sets, as in
+        extract_from_map with copy_batches set to False.
+
+        """
+
+        # Make sure all feature sizes have been calculated.
+        for volume in volumes:
+            self.find_feature_sizes(volume)
+
+        ring = [(self._create_data_arrays(batch_size)[0],
+                 np.zeros(batch_size, dtype='int64'),
+                 np.zeros(batch_size, dtype='int64'))
+                for _ in range(ring_size)]
+        ring_index = 0
+        input_batch, volume_indices, box_positions = ring[ring_index]
+        count = 0
+
+        if orders is None:
+            orders = ['C'] * len(volumes)
+
+        for volume_index, (volume, (lows, box_shape), order) in \
+                enumerate(zip(volumes, boxes, orders)):
+            box_size = int(np.prod(box_shape))
+            position = 0
+            while position < box_size:
+
+                # Take enough of the box to fill the batch.
+                positions = np.arange(
+                    position, min(position + batch_size - count, box_size))
+                position += len(positions)
+                points = np.array(np.unravel_index(positions, box_shape,
+                                                   order=order)).T + \
+                    np.array(lows)
+
+                # Extract the valid points, and record where they came from.
+                valid = self._extract_rows(volume, points, input_batch, count)
+                stop = count + int(np.count_nonzero(valid))
+                volume_indices[count:stop] = volume_index
+                box_positions[count:stop] = positions[valid]
+                count = stop
+
+                if count == batch_size:
+                    yield self._process_input_batch(input_batch, True,
+                                                    False), \
+                        volume_indices, box_positions
+                    count = 0
+
+                    # Move on to the next set of arrays.
+                    ring_index = (ring_index + 1) % len(ring)
+                    input_batch, volume_indices, box_positions = \
+                        ring[ring_index]
+
+        # Yield the last batch at its actual size.
+        if count > 0:
+            partial_batch = dict((name, data[:count])
+                                 for name, data in input_batch.items())
+            yield self._process_input_batch(partial_batch, True, False), \
+                volume_indices[:count], box_positions[:count]
+
+    def predict_ensemble(self, nets, volume, batch_size, bounds=None,
+                         transforms=None, sinks=None, pipeline_depth=None):
+        """
+        Predict with several nets and input transforms in one pass.
+
+        Args
+            nets (list): the nets to predict with, which must all take the
+                features of this extractor.
+            volume (Volume): the volume to predict on.
+            batch_size (int): the number of points to evaluate in a batch.
+            bounds (tuple): optional bounds, as for predict.
+            transforms (list): functions that take an input batch and return
+                a transformed copy (e.g. FlipTransform, IntensityTransform).
+                None stands for the untransformed batch, and is the default.
+            sinks (list): optional sinks for the mean and the variance (see
+                predict).
+            pipeline_depth (int): the number of batches to extract ahead of
+                the nets on a worker thread (see predict).
+
+        Returns
+            mean_volume (Volume): a copy of the volume with the mean predicted
+                probability as its seg_data.
+            variance_volume (Volume): a copy of the volume (with '_variance'
+                added to its name) with the variance of the predicted
+                probabilities as its seg_data.
+
+        Notes
+            Each batch is extracted once, in raster order as for predict, and
+            every net is evaluated on every transform of it.
+
+        """
+
+        if transforms is None:
+            transforms = [None]
+        if sinks is None:
+            sinks = [ArraySink(volume.shape), ArraySink(volume.shape)]
+
+        lows, highs = self.valid_box(volume, bounds)
+        box_shape = [max(high - low, 0) for low, high in zip(lows, highs)]
+        writers = [_SliceWriter(sink, lows, box_shape, sinks[0].order)
+                   for sink in sinks]
+
+        # Evaluate every net and transform on each batch.
+        runner = _EnsembleRunner(nets, transforms, pipeline_depth)
+        batches = self.extract_from_box(volume, batch_size, bounds=bounds,
+                                        copy_batches=False,
+                                        ring_size=runner.ring_size,
+                                        order=sinks[0].order)
+        evaluations = 0
+        for predicted_data, _, box_positions in runner.evaluate(batches):
+            if isinstance(box_positions, slice):
+                box_positions = np.arange(box_positions.start,
+                                          box_positions.stop)
+            for writer, statistic in zip(writers, predicted_data):
+                writer.write(box_positions, statistic[:len(box_positions)])
+            evaluations += len(box_positions)
+
+        for writer, sink in zip(writers, sinks):
+            writer.close()
+            sink.flush()
+
+        # Record how much work was done.
+        member_count = len(nets) * len(transforms)
+        self.network_evaluations[volume.name] = {
+            'evaluations': evaluations * member_count,
+            'saved': (int(np.prod(box_shape)) - evaluations) * member_count
+        }
+        self.prediction_times = runner.times
+
+        return tuple(Volume(
+            name,
+            volume.header,
+            volume.affine,
+            volume.mri_data,
+            sink.data,
+            copy.deepcopy(volume.landmarks)
+        ) for name, sink in zip([volume.name, volume.name + '_variance'],
+                                sinks))
+
+    def _get_dense_predictor(self, net, slab_size):
+        """An internal method to get a (cached) dense predictor for a net."""
+
+        from .dense import DensePredictor
+
+        if self._dense_predictor is None or \
+                self._dense_predictor[0] is not net or \
+                self._dense_predictor[1].slab_size != slab_size:
+            self._dense_predictor = \
+                (net, DensePredictor(net, self, slab_size=slab_size))
+
+        return self._dense_predictor[1]
+
+
+def _grid_coordinates(size, stride):
+    """An internal function to get the positions of a grid along an axis."""
+
+    # Always include the last position, so that every point lies within the
+    # grid.
+    coordinates = np.arange(0, size, stride)
+    if coordinates[-1] != size - 1:
+        coordinates = np.append(coordinates, size - 1)
+
+    return coordinates
+
+
+def _grid_cells(coordinates, fine_coordinates):
+    """
+    An internal function to find the grid coordinates that some fine
+    coordinates along an axis are interpolated from.
+
+    Returns the start and stop of the slice of coordinates holding every
+    cell that _refine_grid would use for the fine coordinates.
+
+    """
+
+    left = np.searchsorted(coordinates, fine_coordinates, 'right') - 1
+    left = np.clip(left, 0, max(len(coordinates) - 2, 0))
+
+    return int(left.min()), min(int(left.max()) + 2, len(coordinates))
+
+
+def _box_slabs(lows, box_shape, axis, slab_size=2 ** 20):
+    """
+    An internal generator of the slabs of a box along an axis.
+
+    Yields the first index and the shape of each slab, which holds as many
+    whole slices as fit in slab_size points (and at least one).
+
+    """
+
+    slice_size = int(np.prod(box_shape)) // max(box_shape[axis], 1)
+    thickness = max(slab_size // max(slice_size, 1), 1)
+    for start in range(0, box_shape[axis], thickness):
+        slab_lows = list(lows)
+        slab_lows[axis] += start
+        slab_shape = list(box_shape)
+        slab_shape[axis] = min(thickness, box_shape[axis] - start)
+        yield slab_lows, slab_shape
+
+
+def _grid_points(grid, mask, lows):
+    """An internal function to get the volume points of masked grid points."""
+
+    indices = np.nonzero(mask)
+    points = [coordinates[axis_indices] + low for coordinates, axis_indices,
+              low in zip(grid, indices, lows)]
+
+    return np.array(points, dtype='int64').reshape(3, -1).T
+
+
+def _refine_grid(values, grid, fine_grid):
+    """
+    An internal function to interpolate grid values onto a finer grid.
+
+    Returns the linearly interpolated values, and a mask of the fine points
+    in cells whose corner values straddle 0.5.
+
+    """
+
+    estimates = values
+    lowest = values
+    highest = values
+    for axis, (coordinates, fine_coordinates) in \
+            enumerate(zip(grid, fine_grid)):
+
+        # Find the cell that each fine point lies in.
+        if len(coordinates) == 1:
+            left = np.zeros(len(fine_coordinates), dtype='int64')
+            estimates = np.take(estimates, left, axis=axis)
+            lowest = np.take(lowest, left, axis=axis)
+            highest = np.take(highest, left, axis=axis)
+            continue
+        left = np.searchsorted(coordinates, fine_coordinates, 'right') - 1
+        left = np.clip(left, 0, len(coordinates) - 2)
+        right = left + 1
+
+        # Interpolate along the axis.
+        weights = (fine_coordinates - coordinates[left]) / \
+            (coordinates[right] - coordinates[left])
+        weights_shape = [1] * values.ndim
+        weights_shape[axis] = len(weights)
+        weights = weights.reshape(weights_shape).astype('float32')
+        estimates = np.take(estimates, left, axis=axis) * (1 - weights) + \
+            np.take(estimates, right, axis=axis) * weights
+
+        # Take the extremes of each cell.
+        lowest = np.minimum(np.take(lowest, left, axis=axis),
+                            np.take(lowest, right, axis=axis))
+        highest = np.maximum(np.take(highest, left, axis=axis),
+                             np.take(highest, right, axis=axis))
+
+    return estimates.astype('float32'), (lowest < 0.5) & (highest >= 0.5)
+
+
+class _NetRunner:
+    """
+    An internal class to evaluate a net on batches, timing each stage.
+
+    Batches are tuples starting with the input batch, and the net's
+    predictions replace it in the tuples that are generated.  If
+    pipeline_depth is given, the batches are extracted on a worker thread
+    (see Prefetcher), so the generator of batches must use a ring of at
+    least ring_size sets of arrays.
+
+    """
+
+    def __init__(self, net, pipeline_depth=None):
+        self.net = net
+        self.pipeline_depth = pipeline_depth
+        self.times = {'extraction': 0.0, 'network': 0.0, 'stall': 0.0}
+
+    @property
+    def ring_size(self):
+        if self.pipeline_depth:
+            return self.pipeline_depth + 2
+        return 1
+
+    def evaluate(self, batches):
+
+        for batch in self._timed_batches(batches):
+            network_start_time = time.time()
+            predicted_data = self._predict(batch[0])
+            self.times['network'] += time.time() - network_start_time
+            yield (predicted_data,) + tuple(batch[1:])
+
+    def _predict(self, input_batch):
+        return np.ravel(self.net.predict(input_batch))
+
+    def _timed_batches(self, batches):
+
+        # Extract ahead on a worker thread if required.
+        if self.pipeline_depth:
+            prefetcher = Prefetcher(batches, depth=self.pipeline_depth)
+            try:
+                for batch in prefetcher:
+                    yield batch
+            finally:
+                prefetcher.close()
+                self.times['extraction'] += prefetcher.produce_time
+                self.times['stall'] += prefetcher.stall_time
+            return
+
+        # Otherwise the net waits for every batch to be extracted.
+        batch_iterator = iter(batches)
+        while True:
+            extraction_start_time = time.time()
+            try:
+                batch = next(batch_iterator)
+            except StopIteration:
+                return
+            extraction_time = time.time() - extraction_start_time
+            self.times['extraction'] += extraction_time
+            self.times['stall'] += extraction_time
+            yield batch
+
+
+class _EnsembleRunner(_NetRunner):
+    """
+    An internal class to evaluate several nets on transformed batches.
+
+    The predictions for each batch are a 2 x N array holding the mean and
+    variance over every combination of net and transform.
+
+    """
+
+    def __init__(self, nets, transforms, pipeline_depth=None):
+        _NetRunner.__init__(self, None, pipeline_depth)
+        self.nets = nets
+        self.transforms = transforms
+
+    def _predict(self, input_batch):
+
+        predictions = []
+        for transform in self.transforms:
+            if transform is not None:
+                transformed_batch = transform(input_batch)
+            else:
+                transformed_batch = input_batch
+            for net in self.nets:
+                predictions.append(np.ravel(net.predict(transformed_batch)))
+        predictions = np.array(predictions, dtype='float32')
+
+        return np.array([predictions.mean(axis=0), predictions.var(axis=0)])
+
+
+class _SliceWriter:
+    """
+    An internal class to write raster order results for a box to a sink.
+
+    Positions are indices into the box flattened in order (by default the
+    order of the sink's data), and must increase from one write to the
+    next.  Results are collected for each slice of the box along its slowest
+    axis (the first axis for C order, the last for F order), and each slice
+    is written as soon as results arrive for a later one.
+
+    """
+
+    def __init__(self, sink, lows, box_shape, order=None):
+        self.sink = sink
+        self.lows = list(lows)
+        self.order = sink.order if order is None else order
+        self.axis = 0 if self.order == 'C' else len(box_shape) - 1
+        self.slice_shape = list(box_shape)
+        self.slice_shape[self.axis] = 1
+        self.slice_size = int(np.prod(self.slice_shape))
+        self.pending_slices = {}
+
+    def write(self, positions, values):
+
+        if len(positions) == 0:
+            return
+
+        # Split the results at the slice boundaries.
+        first = positions[0] // self.slice_size
+        last = positions[-1] // self.slice_size
+        splits = np.searchsorted(
+            positions, np.arange(first, last + 2) * self.slice_size)
+        for index, start, stop in zip(range(first, last + 1), splits[:-1],
+                                      splits[1:]):
+            if index not in self.pending_slices:
+                self.pending_slices[index] = \
+                    np.zeros(self.slice_size, dtype='float32')
+            self.pending_slices[index][
+                positions[start:stop] - index * self.slice_size] = \
+                values[start:stop]
+
+        # Slices before the first one written to won't change again.
+        for index in sorted(self.pending_slices):
+            if index < first:
+                self._write_slice(index)
+
+    def close(self):
+        for index in sorted(self.pending_slices):
+            self._write_slice(index)
+
+    def _write_slice(self, index):
+        slice_data = self.pending_slices.pop(index)
+        slice_lows = list(self.lows)
+        slice_lows[self.axis] += index
+        self.sink.write_box(slice_lows, slice_data.reshape(self.slice_shape,
+                                                           order=self.order))
+
+
+def batch_adapter(feature_function):
+    """
+    Wrap a per-point feature function so it can be used as a batch function.
+
+    Args
+        feature_function (function): a function of the form
+            feature_function(volume, point).
+
+    Returns
+        batch_function (function): a function of the form
+            batch_function(volume, points, out) that calls feature_function
+            once for each point.
+
+    Notes
+        This allows existing per-point features to be registered with
+        Extractor.add_batch_feature() alongside true batch features, so that
+        they can be migrated one at a time.  The result can be pickled if
+        feature_function can.
+
+    """
+
+    return _BatchFunction(feature_function)
+
+
+class _BatchFunction:
+    """A picklable batch form of a per-point feature function."""
+
+    def __init__(self, feature_function):
+        self.feature_function = feature_function
+
+    def __call__(self, volume, points, out=None):
+
+        # Extract the data for each point in turn.
+        point_data = [self.feature_function(volume, tuple(point))
+                      for point in points]
+
+        if out is None:
+            return np.array(point_data, dtype='float32')
+
+        for i, data in enumerate(point_data):
+            out[i] = data
+
+        return out
+
+
+class _PointFunction:
+    """A picklable per-point form of a batch feature function."""
+
+    def __init__(self, batch_function):
+        self.batch_function = batch_function
+
+    def __call__(self, volume, point):
+        return self.batch_function(volume, np.array([point]), None)[0]
@@ -3,6 +3,12 @@ from __future__ import division
 import numpy as np
 import scipy.ndimage.interpolation
 
+# The types of landmark names (unicode names are also strings on Python 2).
+try:
+    _string_types = (basestring,)
+except NameError:
+    _string_types = (str,)
+
 
 class FeatureError(Exception):
     """
@@ -52,17 +58,8 @@ def scaled_patch(volume, point, source_kernel, target_kernel, prob_seg=False):
 def raw_patch(volume, point, kernel_shape, prob_seg=False):
     """Fetch raw data for a patch of specified size from a specified volume."""
 
-    # Convert kernel shape to a mutable object for fixing up.
-    kernel_shape = list(kernel_shape)
-
-    # Ensure each kernel dimensions is odd, so it can be centred on a voxel.
-    for i in range(len(kernel_shape)):
-        if kernel_shape[i] % 2 == 0:
-            kernel_shape[i] -= 1
-
-    # The kernel must include 3 dimensions.
-    if len(kernel_shape) != 3:
-        raise FeatureError('The input kernel must include 3 dimensions.')
+    # Make sure the kernel is odd and three dimensional.
+    kernel_shape = odd_kernel_shape(kernel_shape)
 
     # Create arrays to represent the kernel.
     kernel_starts = [-(size // 2) for size in kernel_shape]
@@ -95,6 +92,154 @@ def raw_patch(volume, point, kernel_shape, prob_seg=False):
         return volume.mri_data[patch_indices]
 
 
+def odd_kernel_shape(kernel_shape):
+    """Return a 3D kernel shape with every dimension made odd."""
+
+    # Convert kernel shape to a mutable object for fixing up.
+    kernel_shape = list(kernel_shape)
+
+    # Ensure each kernel dimensions is odd, so it can be centred on a voxel.
+    for i in range(len(kernel_shape)):
+        if kernel_shape[i] % 2 == 0:
+            kernel_shape[i] -= 1
+
+    # The kernel must include 3 dimensions.
+    if len(kernel_shape) != 3:
+        raise FeatureError('The input kernel must include 3 dimensions.')
+
+    return kernel_shape
+
+
+def kernel_margins(kernel_shape):
+    """Get the half-widths of a kernel, for use as an extractor margin."""
+
+    return [size // 2 for size in odd_kernel_shape(kernel_shape)]
+
+
+def patch_batch(volume, points, kernel_shape, prob_seg=False, out=None):
+    """
+    Fetch and process patches of a specified size around many points.
+
+    Args
+        volume (Volume): the volume to extract from.
+        points (numpy.ndarray): an (N, 3) array of voxel coordinates.
+        kernel_shape (iterable): the 3D shape of the patch.
+        prob_seg (bool): extract from prob_seg_data instead of mri_data.
+        out (numpy.ndarray): an optional array to write the patches into.
+
+    Returns
+        out (numpy.ndarray): an array of shape (N, 1, ...) holding one patch
+            per point, in the layout produced by patch().
+
+    """
+
+    # Get the raw data as a 4D array.
+    patch_data = raw_patch_batch(volume, points, kernel_shape,
+                                 prob_seg=prob_seg)
+
+    # Singleton kernel dimensions are dropped, as in reshape_patch().
+    patch_shape = [len(patch_data), 1] + \
+        [size for size in patch_data.shape[1:] if size != 1]
+
+    return _write_batch(patch_data.reshape(patch_shape), out)
+
+
+def flat_patch_batch(volume, points, kernel_shape, out=None):
+    """Fetch flat patches of a specified size around many points."""
+
+    # Get the raw data as a 4D array.
+    patch_data = raw_patch_batch(volume, points, kernel_shape)
+
+    return _write_batch(patch_data.reshape(len(patch_data), -1), out)
+
+
+def scaled_patch_batch(volume, points, source_kernel, target_kernel,
+                       prob_seg=False, out=None):
+    """Get patches around many points and resample them to a different size."""
+
+    # Get the scale factors and extract the patches.  The batch axis has a
+    # scale factor of one, so the patches are interpolated independently.
+    scale_factors = \
+        [1] + list(np.array(target_kernel) / np.array(source_kernel))
+    patch_data = raw_patch_batch(volume, points, source_kernel,
+                                 prob_seg=prob_seg)
+    scaled_data = scipy.ndimage.interpolation.zoom(patch_data, scale_factors)
+
+    # Singleton kernel dimensions are dropped, as in reshape_patch().
+    patch_shape = [len(scaled_data), 1] + \
+        [size for size in target_kernel if size != 1]
+
+    return _write_batch(scaled_data.reshape(patch_shape), out)
+
+
+def raw_patch_batch(volume, points, kernel_shape, prob_seg=False):
+    """
+    Fetch raw data for patches of specified size around many points.
+
+    Args
+        volume (Volume): the volume to extract from.
+        points (numpy.ndarray): an (N, 3) array of voxel coordinates.
+        kernel_shape (iterable): the 3D shape of the patch.
+        prob_seg (bool): extract from prob_seg_data instead of mri_data.
+
+    Returns
+        patch_data (numpy.ndarray): an array of shape (N,) + kernel_shape.
+
+    Notes
+        All patches are gathered with a single fancy index, using precomputed
+        offsets into the flattened data where its memory layout allows.  A
+        FeatureError is raised if any one of the patches is out of bounds.
+
+    """
+
+    # Make sure the kernel is odd and three dimensional.
+    kernel_shape = odd_kernel_shape(kernel_shape)
+    half_widths = np.array([size // 2 for size in kernel_shape])
+
+    # Check the validity of all patch frames at once.
+    points = np.asarray(points, dtype='int64').reshape(-1, 3)
+    if np.any(points - half_widths < 0):
+        raise FeatureError('Patch index too small.')
+    elif np.any(points + half_widths >= np.array(volume.shape)):
+        raise FeatureError('Patch index too large.')
+
+    if prob_seg:
+        data = volume.prob_seg_data
+    else:
+        data = volume.mri_data
+
+    # Create broadcastable arrays of kernel offsets along each axis.
+    axis_offsets = np.ix_(*[np.arange(-half_width, half_width + 1)
+                            for half_width in half_widths])
+
+    # Contiguous data can be gathered through linear indices, which avoids
+    # building a full index array for every axis.
+    if data.flags.c_contiguous or data.flags.f_contiguous:
+        element_strides = np.array(data.strides) // data.itemsize
+        kernel_offsets = sum(offsets * stride for offsets, stride in
+                             zip(axis_offsets, element_strides))
+        centres = points.dot(element_strides)
+        linear_indices = centres.reshape(-1, 1, 1, 1) + kernel_offsets
+        return data.ravel(order='A')[linear_indices]
+
+    # Otherwise fall back to indexing along each axis.
+    indices = tuple(points[:, i].reshape(-1, 1, 1, 1) + axis_offsets[i]
+                    for i in range(3))
+
+    return data[indices]
+
+
+def _write_batch(batch_data, out):
+    """Copy batch data into an output array if one has been supplied."""
+
+    if out is None:
+        return np.asarray(batch_data, dtype='float32')
+
+    out[...] = batch_data.reshape(out.shape)
+
+    return out
+
+
 def reshape_patch(patch_data, kernel_shape):
     """Reshape raw patch data to be compatible with neural net input."""
 
@@ -129,10 +274,41 @@ def landmark_displacement(volume, point, landmark_name):
     # Convert the coordinates of the point to an array for ease of use.
     coordinate_array = np.array(point)
 
-    # Do the same for voxel spacings.
-    spacing_array = np.array(volume.header.get_zooms()[:3])
+    return coordinate_array * volume.spacing - volume.landmarks[landmark_name]
+
+
+def landmark_displacement_batch(volume, points, landmark_names, out=None):
+    """
+    Get the displacements of many points from one or more landmarks.
+
+    Args
+        volume (Volume): the volume containing the landmarks.
+        points (numpy.ndarray): an (N, 3) array of voxel coordinates.
+        landmark_names (str/iterable): the name of a single landmark, or a
+            list of names.
+        out (numpy.ndarray): an optional array to write the displacements
+            into.
+
+    Returns
+        out (numpy.ndarray): an (N, 3) float32 array for a single landmark, or
+            an (N, L, 3) float32 array for a list of L landmarks.
 
-    return coordinate_array * spacing_array - volume.landmarks[landmark_name]
+    """
+
+    # Allow a single landmark name to be given.
+    single = isinstance(landmark_names, _string_types)
+    if single:
+        landmark_names = [landmark_names]
+
+    # Compute every displacement with one broadcast operation.
+    points = np.asarray(points).reshape(-1, 3)
+    displacements = (points * volume.spacing)[:, np.newaxis, :] - \
+        volume.landmark_array(landmark_names)[np.newaxis, :, :]
+
+    if single:
+        displacements = displacements[:, 0]
+
+    return _write_batch(displacements, out)
 
 
 def point_offset(volume, point, offset):
@@ -143,3 +319,176 @@ def point_offset(volume, point, offset):
     offset_array = np.array(offset)
 
     return volume.mri_data[tuple(point_array + offset_array)].reshape(1)
+
+
+def point_offset_batch(volume, points, offset, out=None):
+    """Get the intensities of voxels offset from many points."""
+
+    # Find the offset points, and check that they are all in the volume.
+    offset_points = np.asarray(points).reshape(-1, 3) + np.array(offset)
+    if np.any(offset_points < 0) or \
+            np.any(offset_points >= np.array(volume.shape)):
+        raise FeatureError('Offset point outside of volume.')
+
+    intensities = volume.mri_data[tuple(offset_points.T)]
+
+    return _write_batch(intensities.reshape(-1, 1), out)
+
+
+class Feature:
+    """
+    A declarative specification of a feature that can be given to Extractor.
+
+    Notes
+        Feature objects are batch feature functions, i.e. they are called as
+        feature(volume, points, out=None) with an (N, 3) array of points.
+        Unlike lambdas, they can be pickled, compared and hashed, and they
+        declare the shape of their data and their margins (the half-widths of
+        the region they read around a point) without touching any data.
+
+        Subclasses set the parameters that identify them in _params, and
+        implement __call__, shape and margins.
+
+    """
+
+    _params = ()
+
+    def __call__(self, volume, points, out=None):
+        raise NotImplementedError
+
+    @property
+    def shape(self):
+        """The shape of the data extracted for a single point."""
+        raise NotImplementedError
+
+    @property
+    def margins(self):
+        """The half-widths of the region read around a point."""
+        raise NotImplementedError
+
+    def extract_point(self, volume, point):
+        """Extract the data for a single point."""
+
+        return self(volume, np.array([point]))[0]
+
+    def _key(self):
+        """An internal method giving a hashable identity for the feature."""
+
+        return (self.__class__.__name__,) + tuple(
+            tuple(value) if isinstance(value, (list, np.ndarray)) else value
+            for value in self._params)
+
+    def __eq__(self, other):
+        return isinstance(other, Feature) and self._key() == other._key()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self._key())
+
+    def __repr__(self):
+        return '{}{}'.format(self.__class__.__name__, self._key()[1:])
+
+
+class PatchFeature(Feature):
+    """A feature specification for patch()."""
+
+    def __init__(self, kernel_shape, prob_seg=False):
+        self.kernel_shape = list(kernel_shape)
+        self.prob_seg = prob_seg
+        self._params = (self.kernel_shape, self.prob_seg)
+
+    def __call__(self, volume, points, out=None):
+        return patch_batch(volume, points, self.kernel_shape,
+                           prob_seg=self.prob_seg, out=out)
+
+    @property
+    def shape(self):
+        kernel_shape = odd_kernel_shape(self.kernel_shape)
+        return tuple([1] + [size for size in kernel_shape if size != 1])
+
+    @property
+    def margins(self):
+        return tuple(kernel_margins(self.kernel_shape))
+
+
+class FlatPatchFeature(Feature):
+    """A feature specification for flat_patch()."""
+
+    def __init__(self, kernel_shape):
+        self.kernel_shape = list(kernel_shape)
+        self._params = (self.kernel_shape,)
+
+    def __call__(self, volume, points, out=None):
+        return flat_patch_batch(volume, points, self.kernel_shape, out=out)
+
+    @property
+    def shape(self):
+        return (int(np.prod(odd_kernel_shape(self.kernel_shape))),)
+
+    @property
+    def margins(self):
+        return tuple(kernel_margins(self.kernel_shape))
+
+
+class ScaledPatchFeature(Feature):
+    """A feature specification for scaled_patch()."""
+
+    def __init__(self, source_kernel, target_kernel, prob_seg=False):
+        self.source_kernel = list(source_kernel)
+        self.target_kernel = list(target_kernel)
+        self.prob_seg = prob_seg
+        self._params = (self.source_kernel, self.target_kernel, self.prob_seg)
+
+    def __call__(self, volume, points, out=None):
+        return scaled_patch_batch(volume, points, self.source_kernel,
+                                  self.target_kernel, prob_seg=self.prob_seg,
+                                  out=out)
+
+    @property
+    def shape(self):
+        return tuple([1] + [size for size in self.target_kernel if size != 1])
+
+    @property
+    def margins(self):
+        return tuple(kernel_margins(self.source_kernel))
+
+
+class LandmarkDisplacementFeature(Feature):
+    """A feature specification for landmark_displacement()."""
+
+    def __init__(self, landmark_name):
+        self.landmark_name = landmark_name
+        self._params = (self.landmark_name,)
+
+    def __call__(self, volume, points, out=None):
+        return landmark_displacement_batch(volume, points, self.landmark_name,
+                                           out=out)
+
+    @property
+    def shape(self):
+        return (3,)
+
+    @property
+    def margins(self):
+        return (0, 0, 0)
+
+
+class PointOffsetFeature(Feature):
+    """A feature specification for point_offset()."""
+
+    def __init__(self, offset):
+        self.offset = list(offset)
+        self._params = (self.offset,)
+
+    def __call__(self, volume, points, out=None):
+        return point_offset_batch(volume, points, self.offset, out=out)
+
+    @property
+    def shape(self):
+        return (1,)
+
+    @property
+    def margins(self):
+        return tuple(abs(component) for component in self.offset)
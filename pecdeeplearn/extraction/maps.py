@@ -1,7 +1,9 @@
 from __future__ import division
 
 import numpy as np
-import random
+import scipy.ndimage
+
+from .pointset import PointSet
 
 
 def probability_bins(volumes, num_bins=25, scale=None):
@@ -10,8 +12,8 @@ def probability_bins(volumes, num_bins=25, scale=None):
 
     Args
         vols (list): a list of Volume objects that are to be used for
-            creating the bins and probabilities.  All elements should be of the
-            same size.
+            creating the bins and probabilities.  They may be of different
+            sizes.
         num_bins (int): the number of bins to create.
         scale (float): the value to scale the probabilities to.  E.g. if
             scale = 1, then all probabilities in prob_bins are scaled by the
@@ -23,28 +25,39 @@ def probability_bins(volumes, num_bins=25, scale=None):
         prob_bins (np.array): num_bins floats that give the probability of a
             voxel that belongs to a particular bin being segmented
 
-    """
-
-    # Strip mri and seg data into separate arrays.
-    all_mri_data = np.array([volume.mri_data for volume in volumes])
-    all_seg_data = np.array([volume.seg_data for volume in volumes])
-
-    # Get the total number of voxels in each bin, and the bin boundaries.
-    voxel_counts, bins = np.histogram(all_mri_data, bins=num_bins)
+    Notes
+        The volumes are read a slab at a time, twice: once to find the
+        intensity range, and once to count the voxels (and segmented voxels)
+        in each of the equal width bins spanning it.  So memory use doesn't
+        grow with the number of volumes, and memory-mapped data is never read
+        in whole.
 
-    # Create a corresponding vols with each element being a bin label.
-    voxel_bin_indices = np.digitize(all_mri_data, bins)
-
-    # Strip away only those elements that are segmented.
-    seg_bin_indices = voxel_bin_indices * all_seg_data
-
-    # Count the number of segmented elements in each bin (discard first count,
-    # as this corresponds to non-segmented elements).
-    seg_counts = np.bincount(seg_bin_indices.flatten())[1:]
+    """
 
-    # Lengthen the counts array if the end was truncated due to no voxels
-    # in later classes being segmented.
-    seg_counts = np.append(seg_counts, np.zeros(num_bins - len(seg_counts)))
+    # Use the type that the intensities would have if they were stacked, so
+    # the bins are the same as for a single histogram of all of them.
+    dtype = np.result_type(*[volume.mri_data.dtype for volume in volumes])
+
+    # Find the intensity range of all the volumes.
+    min_intensity = np.inf
+    max_intensity = -np.inf
+    for mri_chunk, _ in _volume_chunks(volumes, dtype):
+        if mri_chunk.size > 0:
+            min_intensity = min(min_intensity, np.amin(mri_chunk))
+            max_intensity = max(max_intensity, np.amax(mri_chunk))
+
+    # Count the voxels and segmented voxels in each bin, as np.histogram
+    # would over all the data at once (the last bin includes its upper edge).
+    voxel_counts = np.zeros(num_bins, dtype='int64')
+    seg_counts = np.zeros(num_bins, dtype='int64')
+    bins = None
+    for mri_chunk, seg_chunk in _volume_chunks(volumes, dtype):
+        chunk_counts, bins = np.histogram(
+            mri_chunk, bins=num_bins, range=(min_intensity, max_intensity))
+        voxel_counts += chunk_counts
+        seg_counts += np.histogram(
+            mri_chunk[seg_chunk != 0], bins=num_bins,
+            range=(min_intensity, max_intensity))[0]
 
     # Calculate the probabilities and return.
     prob_bins = seg_counts / voxel_counts
@@ -54,6 +67,29 @@ def probability_bins(volumes, num_bins=25, scale=None):
     return bins, prob_bins
 
 
+def _volume_chunks(volumes, dtype, chunk_size=2 ** 22):
+    """An internal generator of slabs of mri and seg data from volumes."""
+
+    for volume in volumes:
+
+        # Slice along the slowest varying axis of the data (the last axis for
+        # Fortran ordered data, such as memory-mapped NIfTI files), so each
+        # slab is a contiguous part of it.
+        flags = volume.mri_data.flags
+        if flags.f_contiguous and not flags.c_contiguous:
+            axis = volume.mri_data.ndim - 1
+        else:
+            axis = 0
+
+        # Take as many whole slices as fit in a chunk.
+        slice_size = int(np.prod(volume.shape)) // max(volume.shape[axis], 1)
+        slab_size = max(chunk_size // max(slice_size, 1), 1)
+        for start in range(0, volume.shape[axis], slab_size):
+            slab = (slice(None),) * axis + (slice(start, start + slab_size),)
+            yield (np.asarray(volume.mri_data[slab], dtype=dtype),
+                   np.asarray(volume.seg_data[slab]))
+
+
 def probability_map(volume, bins, prob_bins):
     """Make a random training map from the likelihood that a voxel is a pec."""
 
@@ -74,7 +110,7 @@ def probability_map(volume, bins, prob_bins):
     # Threshold according to random volumes and voxel probabilities.
     prob_map[prob_map < random_volume] = 0
 
-    return prob_map
+    return PointSet.from_mask(prob_map)
 
 
 def segmentation_map(volumes):
@@ -83,55 +119,109 @@ def segmentation_map(volumes):
     # Count the number of times each voxel is segmented.
     counts = sum([volume.seg_data for volume in volumes])
 
-    return counts.astype(np.bool)
+    return PointSet.from_mask(counts)
 
 
 def full_map(volume):
     """Create a training map encompassing the whole of the input vol."""
 
-    return np.ones(volume.shape)
+    return PointSet(volume.shape)
+
 
+def random_generator(seed=None):
+    """
+    Get a random generator to sample training points with.
+
+    Args
+        seed (int): the seed for a new generator, or an existing generator
+            to use as is.  None seeds from the operating system.
+
+    Returns
+        generator (numpy.random.Generator): a generator, or a
+            numpy.random.RandomState where NumPy is too old to have them.
+
+    """
+
+    if hasattr(seed, 'choice'):
+        return seed
+    if hasattr(np.random, 'default_rng'):
+        return np.random.default_rng(seed)
+
+    return np.random.RandomState(seed)
+
+
+def sample_indices_by_value(array, value, max_samples, forbidden_indices=None,
+                            seed=None):
+    """
+    Take a random sample of non-forbidden points holding a certain value.
 
-def sample_indices_by_value(array, value, max_samples, forbidden_indices=None):
-    """Take a random sample of non-forbidden points holding a certain value."""
+    Args
+        array (numpy.ndarray): the array to sample points from.
+        value: the value that sampled points must hold.
+        max_samples (int): the most points to sample.  If fewer points match,
+            all of them are returned.
+        forbidden_indices (numpy.ndarray): indices (with a size of len(
+            array.shape) along the first axis) of points that must not be
+            sampled.  Any outside the array are ignored.
+        seed: the seed or generator to sample with (see random_generator).
 
-    # Get all points in the array that match the target value.
-    points = np.array(np.where(array == value)).T
+    Returns
+        indices (numpy.ndarray): the indices of the sampled points, with a
+            size of len(array.shape) along the first axis.
 
-    # If there are some forbidden points, then remove them.
-    if forbidden_indices is not None:
+    """
 
-        # Copying the points array is required to allow the necessary views to
-        # be taken.
-        points = points.copy()
+    # Mark the points that match the target value, in a scratch mask.
+    matches = np.asarray(array) == value
 
-        # Reshape the forbidden input into a list of points (with a size of 3
-        # along the second axis).
-        forbidden_points = forbidden_indices.T
+    # If there are some forbidden points, then unmark them.
+    if forbidden_indices is not None and np.size(forbidden_indices) > 0:
+        forbidden_indices = np.asarray(forbidden_indices).reshape(
+            matches.ndim, -1)
+        inside = np.all((forbidden_indices >= 0) &
+                        (forbidden_indices.T < matches.shape).T, axis=0)
+        matches[tuple(forbidden_indices[:, inside])] = False
 
-        # Take views into each points array that allow comparison of rows, then
-        # take the set difference and reshape back into an array of points.
-        points_rows = points.view([('', points.dtype)] * points.shape[1])
-        forbidden_points_rows = \
-            forbidden_points.view(
-                [('', forbidden_points.dtype)] * forbidden_points.shape[1])
-        points = np.setdiff1d(points_rows, forbidden_points_rows).view(
-            points.dtype).reshape(-1, points.shape[1])
+    # Work with the linear indices of the points, and only sample if needed.
+    linear_indices = np.flatnonzero(matches)
+    if len(linear_indices) > max_samples:
+        linear_indices = linear_indices[_choose_positions(
+            random_generator(seed), len(linear_indices), max_samples)]
 
     # Return indices (with a size of 3 along the first axis), rather that
     # points (with a size of 3 along the second axis).
-    if len(points) < max_samples:
-        return points.T
-    else:
-        return np.array(random.sample(points, max_samples)).T
+    return np.array(np.unravel_index(linear_indices, matches.shape),
+                    dtype=np.intp).reshape(matches.ndim, -1)
+
+
+def _choose_positions(generator, num_positions, num_samples):
+    """An internal function to choose distinct positions in range(n)."""
+
+    # Generators choose without replacement efficiently.
+    if not isinstance(generator, np.random.RandomState):
+        return generator.choice(num_positions, num_samples, replace=False)
+
+    # A RandomState permutes every position, so for small samples draw with
+    # replacement and discard repeats instead.
+    if num_samples > num_positions // 4:
+        return generator.permutation(num_positions)[:num_samples]
+    positions = np.unique(generator.randint(num_positions, size=num_samples))
+    while len(positions) < num_samples:
+        positions = np.union1d(positions, generator.randint(
+            num_positions, size=num_samples - len(positions)))
+    generator.shuffle(positions)
 
+    return positions
 
-def half_half_map(volume, max_points=None, margins=(0, 0, 0)):
+
+def half_half_map(volume, max_points=None, margins=(0, 0, 0), seed=None):
     """Create training map with equal # segmented and non-segmented voxels."""
 
+    generator = random_generator(seed)
+
     # Create slices to use for extracting the inner part of the volume.
-    margined_slices = [slice(margin, max_size - margin)
-                       for margin, max_size in zip(margins, volume.shape)]
+    margined_slices = tuple(slice(margin, max_size - margin)
+                            for margin, max_size in zip(margins, volume.shape))
 
     # Extract the inner part (within the margins).
     margined_data = np.around(volume.seg_data[margined_slices]).astype('bool')
@@ -147,12 +237,13 @@ def half_half_map(volume, max_points=None, margins=(0, 0, 0)):
 
     # Return a blank map if either class is empty.
     if num_class_points == 0:
-        return np.full(volume.shape, False, dtype='bool')
+        return PointSet(volume.shape, [])
 
     # Generate the samples of points to use for each class.
-    seg_indices = sample_indices_by_value(margined_data, 1, num_class_points)
-    non_seg_indices = \
-        sample_indices_by_value(margined_data, 0, num_class_points)
+    seg_indices = sample_indices_by_value(margined_data, 1, num_class_points,
+                                          seed=generator)
+    non_seg_indices = sample_indices_by_value(
+        margined_data, 0, num_class_points, seed=generator)
 
     # Add the margin offsets back on.
     for i, margin in enumerate(margins):
@@ -160,19 +251,18 @@ def half_half_map(volume, max_points=None, margins=(0, 0, 0)):
         non_seg_indices[i] += margin
 
     # Create the map.
-    half_half = np.full(volume.shape, False, dtype='bool')
-    half_half[tuple(seg_indices)] = True
-    half_half[tuple(non_seg_indices)] = True
-
-    return half_half
+    return PointSet.from_indices(
+        volume.shape, np.concatenate([seg_indices, non_seg_indices], axis=1))
 
 
 def targeted_map(volume, max_points=None, margins=(0, 0, 0),
-                 boundary_prop=0.5, boundary_prox=2):
+                 boundary_prop=0.5, boundary_prox=2, seed=None):
+
+    generator = random_generator(seed)
 
     # Create slices to use for extracting the inner part of the volume.
-    margined_slices = [slice(margin, max_size - margin)
-                       for margin, max_size in zip(margins, volume.shape)]
+    margined_slices = tuple(slice(margin, max_size - margin)
+                            for margin, max_size in zip(margins, volume.shape))
 
     # Extract the inner part (within the margins).
     margined_data = volume.seg_data[margined_slices]
@@ -188,7 +278,7 @@ def targeted_map(volume, max_points=None, margins=(0, 0, 0),
 
     # Return a blank map if either class is empty.
     if num_points == 0:
-        return np.full(volume.shape, False, dtype='bool')
+        return PointSet(volume.shape, [])
 
     # Split the point counts according to the boundary proportion.
     num_boundary_points = int(boundary_prop * num_points)
@@ -204,42 +294,49 @@ def targeted_map(volume, max_points=None, margins=(0, 0, 0),
          for start, stop, size in zip(min_bounding_indices,
                                       max_bounding_indices,
                                       volume.shape)]
-    bounding_box = volume.seg_data[bounding_box_slices]
-
-    # Initialise a set to keep boundary points in.
-    boundary_points = set()
-
-    # Keep sampling points until the set is full.
-    while len(boundary_points) < num_boundary_points:
-
-        # Generate a random point.
-        point = np.ndarray(3, dtype='int64')
-        for i, max_size in enumerate(bounding_box.shape):
-            point[i] = \
-                np.random.randint(boundary_prox, max_size - boundary_prox)
-
-        # Form the slices used to test the neighbourhood of the point.
-        test_slices = [slice(index - boundary_prox, index + boundary_prox + 1)
-                       for index in point]
-
-        # If the neighbourhood contains more than one class, add it to the set
-        # of boundary points.
-        if np.unique(bounding_box[test_slices]).size > 1:
-            boundary_points.add(tuple(point))
-
-    # Convert the points into a better form for indexing an np.ndarray.
-    boundary_indices = np.array(list(boundary_points)).T
-
-    # Add the bounding box offsets back on.
-    for i, offset in enumerate(min_bounding_indices):
-        boundary_indices[i] += offset
-
-    # Generate the samples of points to use for each class.
-    seg_indices = sample_indices_by_value(margined_data, 1, num_class_points,
-                                          forbidden_indices=boundary_indices)
-    non_seg_indices = \
-        sample_indices_by_value(margined_data, 0, num_class_points,
-                                forbidden_indices=boundary_indices)
+    bounding_box = volume.seg_data[tuple(bounding_box_slices)] != 0
+
+    # Find the boundary band, where the neighbourhood of a point (within
+    # boundary_prox along each axis) contains more than one class.  This is
+    # where the dilated and eroded segmentations differ.
+    neighbourhood_size = 2 * boundary_prox + 1
+    boundary_band = np.logical_xor(
+        scipy.ndimage.maximum_filter(bounding_box, size=neighbourhood_size),
+        scipy.ndimage.minimum_filter(bounding_box, size=neighbourhood_size))
+
+    # Only use points whose whole neighbourhood is in the bounding box.
+    inner_band = np.zeros_like(boundary_band)
+    inner_slices = tuple(slice(boundary_prox, max_size - boundary_prox)
+                         for max_size in bounding_box.shape)
+    inner_band[inner_slices] = boundary_band[inner_slices]
+
+    # Choose the boundary points at random from the band.
+    band_indices = np.flatnonzero(inner_band)
+    if len(band_indices) < num_boundary_points:
+        raise Exception('The boundary band of volume ' + volume.name +
+                        ' only has ' + str(len(band_indices)) +
+                        ' points, but ' + str(num_boundary_points) +
+                        ' boundary points were requested.')
+    chosen_indices = generator.choice(band_indices, num_boundary_points,
+                                      replace=False)
+
+    # Convert the points into a better form for indexing an np.ndarray, and
+    # add the bounding box offsets back on.
+    boundary_indices = np.array(np.unravel_index(chosen_indices,
+                                                 inner_band.shape))
+    for i, bounding_slice in enumerate(bounding_box_slices):
+        boundary_indices[i] += bounding_slice.start
+
+    # Generate the samples of points to use for each class, avoiding the
+    # boundary points (relative to the margined data).
+    margined_boundary_indices = \
+        boundary_indices - np.reshape(margins, (-1, 1))
+    seg_indices = sample_indices_by_value(
+        margined_data, 1, num_class_points,
+        forbidden_indices=margined_boundary_indices, seed=generator)
+    non_seg_indices = sample_indices_by_value(
+        margined_data, 0, num_class_points,
+        forbidden_indices=margined_boundary_indices, seed=generator)
 
     # Add the margin offsets back on.
     for i, margin in enumerate(margins):
@@ -247,21 +344,22 @@ def targeted_map(volume, max_points=None, margins=(0, 0, 0),
         non_seg_indices[i] += margin
 
     # Create the map.
-    targeted = np.full(volume.shape, False, dtype='bool')
-    targeted[tuple(boundary_indices)] = True
-    targeted[tuple(seg_indices)] = True
-    targeted[tuple(non_seg_indices)] = True
-
-    return targeted
+    return PointSet.from_indices(
+        volume.shape,
+        np.concatenate([boundary_indices, seg_indices, non_seg_indices],
+                       axis=1))
 
 
 def actual_predicted_map(actual_volume, predicted_volume, max_points,
-                         margins=(0, 0, 0), prop_correct_sample=0.5):
+                         margins=(0, 0, 0), prop_correct_sample=0.5,
+                         seed=None):
+
+    generator = random_generator(seed)
 
     # Create slices to use for extracting the inner part of the volume.
     margined_slices = \
-        [slice(margin, max_size - margin)
-         for margin, max_size in zip(margins, actual_volume.shape)]
+        tuple(slice(margin, max_size - margin)
+              for margin, max_size in zip(margins, actual_volume.shape))
 
     # Get the actual and predicted margined segmentations in boolean form.
     actual = actual_volume.seg_data.astype('bool')[margined_slices]
@@ -302,22 +400,26 @@ def actual_predicted_map(actual_volume, predicted_volume, max_points,
     correct_positives_sample = sample_indices_by_value(
         correct_positives,
         True,
-        num_correct_positives_sample
+        num_correct_positives_sample,
+        seed=generator
     )
     correct_negatives_sample = sample_indices_by_value(
         correct_negatives,
         True,
-        num_correct_negatives_sample
+        num_correct_negatives_sample,
+        seed=generator
     )
     false_positives_sample = sample_indices_by_value(
         false_positives,
         True,
-        num_false_positives_sample
+        num_false_positives_sample,
+        seed=generator
     )
     false_negatives_sample = sample_indices_by_value(
         false_negatives,
         True,
-        num_false_negatives_sample
+        num_false_negatives_sample,
+        seed=generator
     )
 
     # Fix the indices of the points (since the margined data has been used).
@@ -328,10 +430,8 @@ def actual_predicted_map(actual_volume, predicted_volume, max_points,
         false_negatives_sample[i] += margin
 
     # Create the map.
-    crf_map_array = np.zeros(actual_volume.shape, dtype='bool')
-    crf_map_array[tuple(correct_positives_sample)] = True
-    crf_map_array[tuple(correct_negatives_sample)] = True
-    crf_map_array[tuple(false_positives_sample)] = True
-    crf_map_array[tuple(false_negatives_sample)] = True
-
-    return crf_map_array
\ No newline at end of file
+    return PointSet.from_indices(
+        actual_volume.shape,
+        np.concatenate([correct_positives_sample, correct_negatives_sample,
+                        false_positives_sample, false_negatives_sample],
+                       axis=1))
\ No newline at end of file
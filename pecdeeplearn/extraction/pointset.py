@@ -0,0 +1,232 @@
+from __future__ import division
+
+import numpy as np
+
+
+class PointSet:
+    """
+    A sparse set of points in a volume, for use as a training or prediction
+    map.
+
+    Args
+        shape (tuple): the shape of the volume the points belong to.
+        linear_indices (array-like): the linear (C order) indices of the
+            points, in any order.  If None, the set is every point of the box
+            given by lows and highs, which is never stored.
+        lows (list): the first index of the box along each axis.  Defaults to
+            the start of the volume.
+        highs (list): one past the last index of the box along each axis.
+            Defaults to the end of the volume.
+
+    Attributes
+        shape (tuple): equals arg.
+        linear_indices (numpy.ndarray): the sorted, distinct linear indices of
+            the points, or None if the set is a box.
+        lows (tuple): the first index of the box along each axis, or None if
+            the set is not a box.
+        highs (tuple): one past the last index of the box along each axis, or
+            None if the set is not a box.
+
+    Notes
+        Points are always ordered as np.nonzero would order them in a map
+        of the volume, so a point set can be used wherever a map array was.
+        Converting a point set to an array (e.g. with np.asarray) gives the
+        equivalent boolean map.
+
+    """
+
+    def __init__(self, shape, linear_indices=None, lows=None, highs=None):
+
+        self.shape = tuple(int(size) for size in shape)
+
+        if linear_indices is None:
+            self.linear_indices = None
+            self.lows = tuple(int(low) for low in
+                              (lows if lows is not None else
+                               [0] * len(self.shape)))
+            self.highs = tuple(int(high) for high in
+                               (highs if highs is not None else self.shape))
+        else:
+            self.linear_indices = np.unique(
+                np.asarray(linear_indices, dtype='int64').ravel())
+            self.lows = None
+            self.highs = None
+
+    @classmethod
+    def from_indices(cls, shape, indices):
+        """Create a point set from indices (as returned by np.nonzero)."""
+
+        indices = np.asarray(indices, dtype='int64').reshape(len(shape), -1)
+
+        return cls(shape, np.ravel_multi_index(tuple(indices), shape))
+
+    @classmethod
+    def from_mask(cls, mask):
+        """Create a point set of the non-zero points of a map array."""
+
+        return cls(np.shape(mask), np.flatnonzero(mask))
+
+    @property
+    def is_box(self):
+        return self.linear_indices is None
+
+    @property
+    def box_shape(self):
+        """The shape of the box, if the set is a box."""
+
+        return tuple(max(high - low, 0)
+                     for low, high in zip(self.lows, self.highs))
+
+    def __len__(self):
+        if self.is_box:
+            return int(np.prod(self.box_shape))
+
+        return len(self.linear_indices)
+
+    def points(self, positions=None):
+        """
+        Get the coordinates of some of the points.
+
+        Args
+            positions (numpy.ndarray): the positions of the points to get, in
+                the order of the set.  Defaults to every point.
+
+        Returns
+            points (numpy.ndarray): an (N, 3) array of coordinates.
+
+        """
+
+        if positions is None:
+            positions = np.arange(len(self))
+
+        if self.is_box:
+            return np.array(np.unravel_index(positions, self.box_shape),
+                            dtype='int64').reshape(len(self.shape), -1).T + \
+                np.array(self.lows, dtype='int64')
+
+        return np.array(np.unravel_index(self.linear_indices[positions],
+                                         self.shape),
+                        dtype='int64').reshape(len(self.shape), -1).T
+
+    def indices(self):
+        """Get the indices of the points (as returned by np.nonzero)."""
+
+        return tuple(self.points().T)
+
+    def values(self, array):
+        """Get the values of a volume sized array at each point."""
+
+        if self.is_box:
+            return np.ravel(array[tuple(slice(low, high) for low, high in
+                                        zip(self.lows, self.highs))])
+
+        return np.asarray(array)[self.indices()]
+
+    def where(self, selected):
+        """Get the points for which a boolean array (one per point) is set."""
+
+        positions = np.flatnonzero(selected)
+        if not self.is_box:
+            return PointSet(self.shape, self.linear_indices[positions])
+
+        return PointSet.from_indices(self.shape, self.points(positions).T)
+
+    def intersect_box(self, lows, highs):
+        """
+        Get the points that lie in a box.
+
+        Args
+            lows (list): the first index of the box along each axis.
+            highs (list): one past the last index of the box along each axis
+                (as returned by Extractor.valid_box).
+
+        Returns
+            point_set (PointSet): the points in both the set and the box.
+
+        """
+
+        if self.is_box:
+            return PointSet(self.shape,
+                            lows=[max(low, start) for low, start in
+                                  zip(self.lows, lows)],
+                            highs=[min(high, stop) for high, stop in
+                                   zip(self.highs, highs)])
+
+        inside = np.ones(len(self.linear_indices), dtype='bool')
+        for coordinates, low, high in zip(
+                np.unravel_index(self.linear_indices, self.shape), lows,
+                highs):
+            inside &= (coordinates >= low) & (coordinates < high)
+
+        return PointSet(self.shape, self.linear_indices[inside])
+
+    def to_mask(self):
+        """Get the equivalent volume sized boolean map."""
+
+        mask = np.zeros(self.shape, dtype='bool')
+        if self.is_box:
+            mask[tuple(slice(low, high) for low, high in
+                       zip(self.lows, self.highs))] = True
+        else:
+            mask.flat[self.linear_indices] = True
+
+        return mask
+
+    def save(self, path):
+        """Save the point set to a compressed .npz file."""
+
+        if self.is_box:
+            np.savez_compressed(path, shape=self.shape, lows=self.lows,
+                                highs=self.highs)
+        else:
+            np.savez_compressed(path, shape=self.shape,
+                                linear_indices=self.linear_indices)
+
+    @classmethod
+    def load(cls, path):
+        """Load a point set saved by save()."""
+
+        with np.load(path) as arrays:
+            if 'linear_indices' in arrays:
+                return cls(arrays['shape'], arrays['linear_indices'])
+
+            return cls(arrays['shape'], lows=arrays['lows'],
+                       highs=arrays['highs'])
+
+    def __array__(self, dtype=None):
+        mask = self.to_mask()
+
+        return mask if dtype is None else mask.astype(dtype)
+
+    def __repr__(self):
+        if self.is_box:
+            return '{}(shape={!r}, lows={!r}, highs={!r})'.format(
+                self.__class__.__name__, self.shape, self.lows, self.highs)
+
+        return '{}(shape={!r}, <{} points>)'.format(
+            self.__class__.__name__, self.shape, len(self))
+
+
+def as_point_set(point_map, shape=None):
+    """
+    Get a point map as a PointSet.
+
+    Args
+        point_map (PointSet/numpy.ndarray): a point set, or a map array whose
+            non-zero elements are the points.
+        shape (tuple): the shape the map must have, if given.
+
+    Returns
+        point_set (PointSet): the points of the map.
+
+    """
+
+    if not isinstance(point_map, PointSet):
+        point_map = PointSet.from_mask(point_map)
+
+    if shape is not None and point_map.shape != tuple(shape):
+        raise Exception('The point map has shape ' + str(point_map.shape) +
+                        ', but the volume has shape ' + str(tuple(shape)) +
+                        '.')
+
+    return point_map
@@ -0,0 +1,201 @@
+from __future__ import division
+
+import sys
+import threading
+import time
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+# Re-raise an exception with its original traceback (Python 2 needs the three
+# argument raise statement, which is a syntax error on Python 3).
+if sys.version_info[0] >= 3:
+    def _reraise(exc_info):
+        raise exc_info[1].with_traceback(exc_info[2])
+else:
+    exec('def _reraise(exc_info):\n'
+         '    raise exc_info[0], exc_info[1], exc_info[2]\n')
+
+
+class Prefetcher:
+    """
+    Iterate over batches that are produced ahead of time on a worker thread.
+
+    Args
+        batches (iterable): the batches to prefetch, e.g. the generator
+            returned by Extractor.iterate_multiple().
+        depth (int): the maximum number of batches to hold ready at once.
+
+    Attributes
+        depth (int): equals arg.
+        batch_count (int): the number of batches consumed so far.
+        stall_time (float): the total time (in seconds) spent waiting for the
+            worker to produce a batch.  A large value means that extraction
+            is the bottleneck.
+        worker_wait_time (float): the total time (in seconds) the worker spent
+            waiting for space in the queue.  A large value means that the
+            consumer (e.g. net.fit) is the bottleneck.
+        produce_time (float): the total time (in seconds) the worker spent
+            producing batches.
+        queue_depth_total (int): the sum of the queue depths seen each time a
+            batch was consumed.
+
+    Notes
+        The worker thread owns the underlying iterator, so it must not be
+        advanced anywhere else.  Batches are held in the queue after they have
+        been produced, so iterators that reuse their arrays (such as the
+        Extractor iterators with copy_batches=False) need a ring_size of at
+        least depth + 2.
+
+        The worker is stopped by close(), on leaving a with block, or when
+        the prefetcher is garbage collected, so breaking out of a loop over
+        it doesn't leave the worker producing batches.  Errors raised by the
+        iterator are re-raised by the consumer with their original
+        traceback.
+
+    """
+
+    def __init__(self, batches, depth=2):
+
+        self.depth = depth
+
+        # Initialise the counters.
+        self.batch_count = 0
+        self.stall_time = 0.0
+        self.queue_depth_total = 0
+
+        # Create the bounded queue and start filling it.  The worker only
+        # holds the shared state, not the prefetcher, so the prefetcher can
+        # be garbage collected (and stop the worker) while it runs.
+        self._state = _WorkerState(depth)
+        self._queue = self._state.queue
+        self._stop_event = self._state.stop_event
+        self._finished = False
+        self._worker = threading.Thread(target=_produce,
+                                        args=(iter(batches), self._state))
+        self._worker.daemon = True
+        self._worker.start()
+
+    @property
+    def worker_wait_time(self):
+        return self._state.worker_wait_time
+
+    @property
+    def produce_time(self):
+        return self._state.produce_time
+
+    @property
+    def queue_depth(self):
+        """The number of batches currently ready to be consumed."""
+
+        return self._queue.qsize()
+
+    @property
+    def mean_queue_depth(self):
+        """The average number of batches ready when a batch was consumed."""
+
+        if self.batch_count == 0:
+            return 0.0
+
+        return self.queue_depth_total / self.batch_count
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+
+        if self._finished:
+            raise StopIteration
+
+        # Record the depth, then wait for the next item.
+        queue_depth = self._queue.qsize()
+        wait_start_time = time.time()
+        kind, value = self._queue.get()
+        self.stall_time += time.time() - wait_start_time
+
+        if kind == 'batch':
+            self.batch_count += 1
+            self.queue_depth_total += queue_depth
+            return value
+
+        # The worker has finished, either normally or with an error.
+        self._finished = True
+        if kind == 'error':
+            _reraise(value)
+        raise StopIteration
+
+    # Python 2 compatibility.
+    next = __next__
+
+    def close(self):
+        """Stop the worker thread and discard any prefetched batches."""
+
+        self._finished = True
+        self._stop_event.set()
+        self._worker.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __del__(self):
+
+        # Don't wait for the worker, which stops at its next batch.
+        self._stop_event.set()
+
+    def stats(self):
+        """Return a dictionary of the pipeline counters."""
+
+        return {'batch_count': self.batch_count,
+                'stall_time': self.stall_time,
+                'worker_wait_time': self.worker_wait_time,
+                'produce_time': self.produce_time,
+                'mean_queue_depth': self.mean_queue_depth}
+
+
+class _WorkerState:
+    """An internal class holding what a prefetcher shares with its worker."""
+
+    def __init__(self, depth):
+        self.queue = queue.Queue(maxsize=depth)
+        self.stop_event = threading.Event()
+        self.worker_wait_time = 0.0
+        self.produce_time = 0.0
+
+
+def _produce(batch_iterator, state):
+    """An internal function to run the iterator on the worker thread."""
+
+    try:
+        while True:
+            produce_start_time = time.time()
+            try:
+                batch = next(batch_iterator)
+            except StopIteration:
+                break
+            state.produce_time += time.time() - produce_start_time
+            if not _put(state, ('batch', batch)):
+                return
+    except Exception:
+        _put(state, ('error', sys.exc_info()))
+    else:
+        _put(state, ('stop', None))
+
+
+def _put(state, item):
+    """An internal function to queue an item unless the prefetcher closes."""
+
+    wait_start_time = time.time()
+    while not state.stop_event.is_set():
+        try:
+            state.queue.put(item, timeout=0.1)
+        except queue.Full:
+            continue
+        state.worker_wait_time += time.time() - wait_start_time
+        return True
+
+    return False
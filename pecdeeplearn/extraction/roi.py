@@ -0,0 +1,104 @@
+from __future__ import division
+
+import numpy as np
+
+
+class LandmarkROI:
+    """
+    A model that predicts a box to segment in from a volume's landmarks.
+
+    Args
+        landmark_names (list): the names of the landmarks to place the box
+            with (e.g. ['Sternal angle', 'Left nipple', 'Right nipple']).
+        margin (float): the extra distance (in mm) to add to every side of
+            the box.
+
+    Attributes
+        landmark_names (list): equals arg.
+        margin (float): equals arg.
+        low_offsets (numpy.ndarray): the smallest offset (in mm) of the
+            segmentation bounding box from the landmark centroid along each
+            axis, across the training volumes.
+        high_offsets (numpy.ndarray): the largest such offset.
+
+    Notes
+        The box is placed relative to the centroid of the landmarks, and
+        spans the union of the training bounding boxes (relative to their
+        own centroids) plus the margin, so no ground truth segmentation is
+        needed to predict it.  The result can be passed straight to
+        Extractor.predict as bounds.
+
+    """
+
+    def __init__(self, landmark_names, margin=5.0):
+
+        self.landmark_names = list(landmark_names)
+        self.margin = margin
+
+        # Initialise the fitted values.
+        self.low_offsets = None
+        self.high_offsets = None
+
+    def _centroid(self, volume):
+        """An internal method to find the centroid of the landmarks (in mm)."""
+
+        return np.mean(volume.landmark_array(self.landmark_names), axis=0)
+
+    def fit(self, volumes):
+        """Learn the box offsets from segmented training volumes."""
+
+        low_offsets = []
+        high_offsets = []
+        for volume in volumes:
+            min_indices, max_indices = volume.bounding_box()
+            centroid = self._centroid(volume)
+            low_offsets.append(min_indices * volume.spacing - centroid)
+            high_offsets.append(max_indices * volume.spacing - centroid)
+
+        self.low_offsets = np.min(low_offsets, axis=0)
+        self.high_offsets = np.max(high_offsets, axis=0)
+
+        return self
+
+    def bounds(self, volume):
+        """
+        Predict the box to segment in for a volume.
+
+        Args
+            volume (Volume): the volume, which only needs its landmarks.
+
+        Returns
+            min_indices (numpy.ndarray): the first index of the box along each
+                axis.
+            max_indices (numpy.ndarray): the last index of the box along each
+                axis (as for Volume.bounding_box).
+
+        """
+
+        if self.low_offsets is None:
+            raise Exception('The ROI model must be fitted before use.')
+
+        centroid = self._centroid(volume)
+        lows = (centroid + self.low_offsets - self.margin) / volume.spacing
+        highs = (centroid + self.high_offsets + self.margin) / volume.spacing
+
+        # Round outwards, and keep the box within the volume.
+        max_indices = np.array(volume.shape) - 1
+        min_indices = np.clip(np.floor(lows).astype('int64'), 0, max_indices)
+        max_indices = np.clip(np.ceil(highs).astype('int64'), 0, max_indices)
+
+        return min_indices, max_indices
+
+    def recall(self, volumes):
+        """Get the fraction of segmented voxels in volumes inside the boxes."""
+
+        seg_count = 0
+        inside_count = 0
+        for volume in volumes:
+            min_indices, max_indices = self.bounds(volume)
+            box_slices = tuple(slice(low, high + 1)
+                               for low, high in zip(min_indices, max_indices))
+            seg_count += np.count_nonzero(volume.seg_data)
+            inside_count += np.count_nonzero(volume.seg_data[box_slices])
+
+        return inside_count / seg_count if seg_count > 0 else 1.0
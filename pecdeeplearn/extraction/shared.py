@@ -0,0 +1,148 @@
+from __future__ import division
+
+import numpy as np
+import os
+import shutil
+import tempfile
+
+from .volume import Volume
+
+
+class SharedVolume(Volume):
+    """
+    A volume whose data is memory-mapped from files held by a VolumeStore.
+
+    Args
+        name (str): the name of the volume.
+        header (nibabel.Nifti1Header): contains metadata for the volume.
+        affine (numpy.ndarray): maps voxel indices to a spatial location.
+        data_paths (dict): contains attribute names (e.g. 'mri_data') as keys
+            and the paths of the .npy files holding their data as values.
+        landmarks (dict): contains landmark names as keys and 3 element
+            coordinate arrays as values.
+
+    Attributes
+        data_paths (dict): equals arg.
+
+    Notes
+        The data is opened read-only, so every process that maps the same
+        files shares a single copy of it in the page cache.  Pickling a
+        SharedVolume only stores the file paths and metadata, and unpickling
+        re-attaches to the files without copying, so handles can be sent to
+        worker processes cheaply.
+
+    """
+
+    def __init__(self, name, header, affine, data_paths, landmarks):
+
+        self.data_paths = data_paths
+
+        # Map the data and initialise the volume around it.
+        data = self._open_data(data_paths)
+        Volume.__init__(self, name, header, affine, data.pop('mri_data'),
+                        data.pop('seg_data'), landmarks)
+
+        # Attach any other arrays (e.g. prob_seg_data).
+        for attribute_name, array in data.items():
+            setattr(self, attribute_name, array)
+
+    @staticmethod
+    def _open_data(data_paths):
+        """An internal method to memory-map each array read-only."""
+
+        return dict((attribute_name, np.load(path, mmap_mode='r'))
+                    for attribute_name, path in data_paths.items())
+
+    def __getstate__(self):
+
+        # Leave out the mapped data and any cached values.
+        return {'name': self.name,
+                'header': self.header,
+                'affine': self.affine,
+                'data_paths': self.data_paths,
+                'landmarks': self.landmarks}
+
+    def __setstate__(self, state):
+        self.__init__(state['name'], state['header'], state['affine'],
+                      state['data_paths'], state['landmarks'])
+
+
+class VolumeStore:
+    """
+    A store that places volume data in shared, file-backed memory once.
+
+    Args
+        directory (str): the directory to write the data files to.  If None,
+            a temporary directory is created in /dev/shm (if available) and
+            removed when the store is closed.
+
+    Attributes
+        directory (str): the directory holding the data files.
+        volumes (list): the SharedVolume handles added to the store, in
+            order.
+
+    Notes
+        Volumes should be fully prepared (e.g. standardised) before they are
+        added, since the shared data is read-only.
+
+    """
+
+    def __init__(self, directory=None):
+
+        # Create a temporary directory in RAM-backed storage by default.
+        self._owns_directory = directory is None
+        if directory is None:
+            ram_directory = '/dev/shm' if os.path.isdir('/dev/shm') else None
+            directory = tempfile.mkdtemp(prefix='pecdeeplearn_',
+                                         dir=ram_directory)
+        elif not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.directory = directory
+        self.volumes = []
+
+    def add(self, volume):
+        """Copy a volume's data into the store and return a shared handle."""
+
+        # Prefix the file names with an index, in case names are repeated.
+        prefix = '{}_{}'.format(len(self.volumes), volume.name)
+
+        # Write each array that is present to its own .npy file.
+        data_paths = {}
+        for attribute_name in ['mri_data', 'seg_data', 'prob_seg_data']:
+            if not hasattr(volume, attribute_name):
+                continue
+            array = getattr(volume, attribute_name)
+            path = os.path.join(self.directory,
+                                prefix + '_' + attribute_name + '.npy')
+            mapped = np.lib.format.open_memmap(path, mode='w+',
+                                               dtype=array.dtype,
+                                               shape=array.shape)
+            mapped[...] = array
+            mapped.flush()
+            del mapped
+            data_paths[attribute_name] = path
+
+        shared_volume = SharedVolume(volume.name, volume.header, volume.affine,
+                                     data_paths, volume.landmarks)
+        self.volumes.append(shared_volume)
+
+        return shared_volume
+
+    def add_all(self, volumes):
+        """Add a list of volumes, returning a list of shared handles."""
+
+        return [self.add(volume) for volume in volumes]
+
+    def close(self):
+        """Remove the data files if the store created its own directory."""
+
+        self.volumes = []
+        if self._owns_directory and os.path.isdir(self.directory):
+            shutil.rmtree(self.directory)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
@@ -0,0 +1,249 @@
+from __future__ import division
+
+import numpy as np
+import os
+
+
+class ArraySink:
+    """
+    A prediction sink that keeps the probabilities in memory.
+
+    Args
+        shape (tuple): the shape of the volume being predicted on.
+
+    Attributes
+        data (numpy.ndarray): the float32 probabilities, which are zero until
+            written.
+
+    Notes
+        Sinks receive predictions a box at a time through write_box (usually
+        a slice or slab along slice_axis at a time), or a point at a time for
+        sparse point maps through write_points, and expose the result as
+        data.  Dense prediction (see Extractor.predict) is the exception,
+        writing slabs along the first axis directly into data.  The rounded
+        segmentation is never stored; rounded_slices computes it a slice at
+        a time.
+
+        Slices are taken along the slowest varying axis of data (the last
+        axis for Fortran ordered data, such as NIfTI files), so each slice
+        is a contiguous part of a file rather than being spread through all
+        of it.
+
+    """
+
+    def __init__(self, shape):
+        self.data = np.zeros(shape, dtype='float32')
+
+    @property
+    def shape(self):
+        return self.data.shape
+
+    @property
+    def order(self):
+        """The order ('C' or 'F') that the data is stored in."""
+
+        flags = self.data.flags
+        if flags.f_contiguous and not flags.c_contiguous:
+            return 'F'
+
+        return 'C'
+
+    @property
+    def slice_axis(self):
+        """The slowest varying axis of the data."""
+
+        return self.data.ndim - 1 if self.order == 'F' else 0
+
+    def write_box(self, lows, box_data):
+        """Write the probabilities of a box with its first index at lows."""
+
+        self.data[tuple(slice(low, low + size) for low, size in
+                        zip(lows, np.shape(box_data)))] = box_data
+
+    def write_points(self, points, values):
+        """Write the probabilities of an (N, 3) array of points."""
+
+        self.data[tuple(np.transpose(points))] = values
+
+    def rounded_slices(self, axis=None):
+        """
+        Generate the rounded (int16) segmentation a slice at a time.
+
+        Args
+            axis (int): the axis to take slices along.  Defaults to
+                slice_axis.
+
+        """
+
+        if axis is None:
+            axis = self.slice_axis
+
+        # Index the slices directly, since np.take would copy the whole of
+        # a Fortran ordered array.
+        for index in range(self.data.shape[axis]):
+            yield np.around(self.data[_axis_index(axis, index)]).astype(
+                'int16')
+
+    def rounded(self):
+        """Get the whole rounded segmentation."""
+
+        return np.around(self.data).astype('int16')
+
+    def flush(self):
+        """Make sure that written data has been stored."""
+
+        pass
+
+
+class NpySink(ArraySink):
+    """
+    A prediction sink that streams the probabilities to a .npy file.
+
+    Args
+        path (str): the path of the .npy file to create.
+        shape (tuple): the shape of the volume being predicted on.
+        resume (bool): whether to map the existing file at path (if there is
+            one) instead of creating a new one, keeping its contents.
+
+    Attributes
+        path (str): equals arg.
+        data (numpy.memmap): the probabilities, mapped from the file.
+
+    """
+
+    def __init__(self, path, shape, resume=False):
+        self.path = path
+        if resume and os.path.isfile(path):
+            self.data = np.lib.format.open_memmap(path, mode='r+')
+            _check_shape(path, self.data.shape, shape)
+        else:
+            self.data = np.lib.format.open_memmap(path, mode='w+',
+                                                  dtype='float32',
+                                                  shape=shape)
+
+    def flush(self):
+        self.data.flush()
+
+    def save_rounded(self, path):
+        """Save the rounded segmentation to a .npy file, a slice at a time."""
+
+        rounded = np.lib.format.open_memmap(
+            path, mode='w+', dtype='int16', shape=self.shape,
+            fortran_order=self.order == 'F')
+        _save_slices(rounded, self.rounded_slices(), self.slice_axis)
+        rounded.flush()
+        del rounded
+
+
+class NiftiSink(ArraySink):
+    """
+    A prediction sink that streams the probabilities to a .nii file.
+
+    Args
+        path (str): the path of the .nii file to create.
+        shape (tuple): the shape of the volume being predicted on.
+        affine (numpy.ndarray): the affine of the volume.
+        header (nibabel header): the header of the volume, used as a template
+            for the new file's header.
+        resume (bool): whether to map the existing file at path (if there is
+            one) instead of creating a new one, keeping its contents.
+
+    Attributes
+        path (str): equals arg.
+        affine (numpy.ndarray): equals arg.
+        header (nibabel.Nifti1Header): the header of the new file.
+        data (numpy.memmap): the probabilities, mapped from the image data in
+            the file.
+
+    """
+
+    def __init__(self, path, shape, affine, header=None, resume=False):
+        self.path = path
+        self.affine = affine
+        if resume and os.path.isfile(path):
+            self.header, self.data = _open_nifti_memmap(path)
+            _check_shape(path, self.data.shape, shape)
+        else:
+            self.header, self.data = \
+                _create_nifti_memmap(path, shape, 'float32', affine, header)
+
+    def flush(self):
+        self.data.flush()
+
+    def save_rounded(self, path):
+        """Save the rounded segmentation to a .nii file, a slice at a time."""
+
+        _, rounded = _create_nifti_memmap(path, self.shape, 'int16',
+                                          self.affine, self.header)
+        _save_slices(rounded, self.rounded_slices(), self.slice_axis)
+        rounded.flush()
+        del rounded
+
+
+def _create_nifti_memmap(path, shape, dtype, affine, header):
+    """An internal function to create a .nii file and map its image data."""
+
+    import nibabel
+
+    # Let nibabel fill in the header, using a placeholder array that doesn't
+    # take up any memory.
+    placeholder = np.broadcast_to(np.zeros(1, dtype=dtype), shape)
+    header = nibabel.Nifti1Image(placeholder, affine, header).header
+    header.set_data_dtype(dtype)
+    header.set_slope_inter(None, None)
+
+    # Write the header (and any extensions), and extend the file to hold the
+    # data, which must start at a multiple of 16 bytes.
+    offset = 352 + int(header.extensions.get_sizeondisk())
+    offset += -offset % 16
+    header.set_data_offset(offset)
+    data_dtype = header.get_data_dtype()
+    data_size = int(np.prod(shape)) * data_dtype.itemsize
+    with open(path, 'wb') as nifti_file:
+        header.write_to(nifti_file)
+        nifti_file.write(b'\0' * (offset - nifti_file.tell()))
+        nifti_file.seek(offset + data_size - 1)
+        nifti_file.write(b'\0')
+
+    # NIfTI data is stored in Fortran order.
+    data = np.memmap(path, dtype=data_dtype, mode='r+', offset=offset,
+                     shape=tuple(shape), order='F')
+
+    return header, data
+
+
+def _open_nifti_memmap(path):
+    """An internal function to map the image data of an existing .nii file."""
+
+    import nibabel
+
+    # Read the header directly, since loaded images don't keep the offset.
+    with open(path, 'rb') as nifti_file:
+        header = nibabel.Nifti1Header.from_fileobj(nifti_file)
+    data = np.memmap(path, dtype=header.get_data_dtype(), mode='r+',
+                     offset=int(header.get_data_offset()),
+                     shape=header.get_data_shape(), order='F')
+
+    return header, data
+
+
+def _save_slices(array, slices, axis):
+    """An internal function to fill an array with slices along an axis."""
+
+    for index, array_slice in enumerate(slices):
+        array[_axis_index(axis, index)] = array_slice
+
+
+def _axis_index(axis, index):
+    """An internal function to get the index of a slice along an axis."""
+
+    return (slice(None),) * axis + (index,)
+
+
+def _check_shape(path, existing_shape, shape):
+    """An internal function to check the shape of a resumed file."""
+
+    if tuple(existing_shape) != tuple(shape):
+        raise Exception('The existing file ' + path + ' has shape ' +
+                        str(tuple(existing_shape)) + ', not ' +
+                        str(tuple(shape)) + '.')
@@ -32,6 +32,8 @@ class Volume:
         orientation (str): equals arg.
         shape (tuple): gives the dimensions of the volume.  Should be
             consistent between mri and seg data.
+        spacing (numpy.ndarray): the voxel spacing along each axis, read
+            from the header.
 
     """
 
@@ -60,6 +62,42 @@ class Volume:
         # If they are consistent, set this as the shape of the volume.
         self.shape = self.mri_data.shape
 
+    @property
+    def spacing(self):
+        """The voxel spacing along each axis, cached as a float array."""
+
+        # Cache the spacing, since reading it from the header is slow relative
+        # to the arithmetic it is used in.
+        if getattr(self, '_spacing', None) is None:
+            self._spacing = np.array(self.header.get_zooms()[:3])
+
+        return self._spacing
+
+    def landmark_array(self, landmark_names):
+        """
+        Get the coordinates of several landmarks as a single array.
+
+        Args
+            landmark_names (iterable): the names of the landmarks to include.
+
+        Returns
+            landmark_array (numpy.ndarray): an (L, 3) array with one row of
+                spatial coordinates per landmark, cached for reuse.
+
+        """
+
+        # Create the cache if required (e.g. for unpickled volumes).
+        if getattr(self, '_landmark_arrays', None) is None:
+            self._landmark_arrays = {}
+
+        landmark_names = tuple(landmark_names)
+        if landmark_names not in self._landmark_arrays:
+            self._landmark_arrays[landmark_names] = np.array(
+                [self.landmarks[name] for name in landmark_names],
+                dtype='float64').reshape(-1, 3)
+
+        return self._landmark_arrays[landmark_names]
+
     def get_slice(self, slice_index, axis):
         """
         Get a slice of data along a specified axis.
@@ -168,9 +206,8 @@ class Volume:
         # Shift the landmarks for the new volume based on the new origin.
         new_landmarks = copy.deepcopy(self.landmarks)
         new_origin_array = np.array(new_origin)
-        spacing_array = np.array(self.header.get_zooms()[:3])
         for landmark_location in new_landmarks.values():
-            landmark_location -= new_origin_array * spacing_array
+            landmark_location -= new_origin_array * self.spacing
 
         return Volume(self.name,
                       self.header,
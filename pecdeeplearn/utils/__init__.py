@@ -1,3 +1,5 @@
 from .experiment import *
+from .mapcache import *
+from .prediction import *
 from .volumetools import *
 from .printing import *
\ No newline at end of file
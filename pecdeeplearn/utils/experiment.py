@@ -5,7 +5,7 @@ import cPickle as pickle
 import nibabel
 import sys
 
-from ..extraction import Volume
+from ..extraction import NiftiSink, Volume
 
 
 class Experiment:
@@ -214,3 +214,14 @@ class Experiment:
                                           volume.header)
             nibabel.save(seg_img, os.path.join(self.experiment_path,
                                                volume.name + '_seg.nii'))
+
+    def create_nii_sink(self, volume, name=None, resume=False):
+        """Create a sink that streams a prediction to a .nii file."""
+
+        # Name the file as export_nii would name the segmentation.
+        if name is None:
+            name = volume.name
+
+        return NiftiSink(os.path.join(self.experiment_path, name + '_seg.nii'),
+                         volume.shape, volume.affine, volume.header,
+                         resume=resume)
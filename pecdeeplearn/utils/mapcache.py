@@ -0,0 +1,210 @@
+from __future__ import division
+
+import hashlib
+import multiprocessing
+import numpy as np
+import os
+import zlib
+
+from ..extraction import PointSet
+
+
+# The job shared with forked worker processes by MapBuilder.build.
+_worker_job = None
+
+
+class MapBuilder:
+    """
+    Build training maps for many volumes, caching them in the experiment.
+
+    Args
+        experiment (Experiment): the experiment to cache the maps in.
+        map_function (function): a map function that takes a volume, any
+            params as keyword arguments, and a seed keyword argument (e.g.
+            extraction.targeted_map), and returns a PointSet or map array.
+        params (dict): the keyword arguments to build every map with (e.g.
+            {'max_points': 25000, 'margins': (10, 10, 0)}).
+        seed (int): the seed that each volume's sampling seed is made from.
+        num_workers (int): if given, maps are built on a pool of this many
+            worker processes.
+        map_name (str): the name to cache the maps under.  Defaults to the
+            name of map_function, and must be given if it has no name of its
+            own (e.g. a lambda or a functools.partial).
+
+    Attributes
+        experiment (Experiment): equals arg.
+        map_function (function): equals arg.
+        params (dict): equals arg.
+        seed (int): equals arg.
+        num_workers (int): equals arg.
+        map_name (str): the name of the maps, used in the cache.
+        cache_path (str): the directory in the experiment holding the maps.
+
+    Notes
+        Each map is saved to cache_path as a compressed .npz file of its
+        points (see PointSet.save), named after the volume and a digest of
+        the map name, params and seed.  Params are compared by value, so
+        lists and tuples, and numpy and Python numbers, give the same
+        digest.  Before building a map, the caches of this experiment and of
+        every other experiment in the results directory are searched for it,
+        so reruns and sibling experiments with the same sampling reuse the
+        same maps.  Found maps are copied into this experiment, so it always
+        holds the maps it was trained on.
+
+        Each volume is sampled with a seed made from seed and the volume's
+        name, so its map doesn't depend on the other volumes or workers.
+        Workers are forked, so they inherit the volumes and map function
+        without pickling them.
+
+    """
+
+    def __init__(self, experiment, map_function, params=None, seed=0,
+                 num_workers=None, map_name=None):
+
+        self.experiment = experiment
+        self.map_function = map_function
+        self.params = dict(params or {})
+        self.seed = seed
+        self.num_workers = num_workers
+        if map_name is None:
+            map_name = getattr(map_function, '__name__', '<lambda>')
+            if map_name == '<lambda>':
+                raise Exception('The map function has no name, so a map_name '
+                                'must be given.')
+        self.map_name = map_name
+        self.cache_path = os.path.join(experiment.experiment_path, 'maps')
+
+    def key(self):
+        """Get the digest that identifies the map function, params and seed."""
+
+        description = repr((self.map_name, _normalise(self.params),
+                            _normalise(self.seed)))
+
+        return hashlib.md5(description.encode('utf-8')).hexdigest()[:16]
+
+    def filename(self, volume_name):
+        """Get the name of the cache file for a volume's map."""
+
+        return volume_name + '_' + self.map_name + '_' + self.key() + '.npz'
+
+    def volume_seed(self, volume_name):
+        """Get the seed to sample a volume's map with."""
+
+        name_hash = zlib.crc32(volume_name.encode('utf-8')) & 0xffffffff
+
+        return [self.seed, name_hash]
+
+    def load(self, volume_name):
+        """Load a cached map, or return None if no experiment has built it."""
+
+        filename = self.filename(volume_name)
+        own_path = os.path.join(self.cache_path, filename)
+        if os.path.isfile(own_path):
+            return PointSet.load(own_path)
+
+        # Look in the caches of the other experiments.
+        results_path = self.experiment.results_path
+        for experiment_name in sorted(os.listdir(results_path)):
+            path = os.path.join(results_path, experiment_name, 'maps',
+                                filename)
+            if os.path.isfile(path):
+                point_map = PointSet.load(path)
+                self._save(volume_name, point_map)
+                return point_map
+
+        return None
+
+    def _save(self, volume_name, point_map):
+        """An internal method to add a map to the cache, atomically."""
+
+        if not os.path.isdir(self.cache_path):
+            os.makedirs(self.cache_path)
+
+        # Write to a temporary file first, so that an interrupted save never
+        # leaves a partial map in the cache.
+        path = os.path.join(self.cache_path, self.filename(volume_name))
+        temp_path = path[:-len('.npz')] + '.tmp.npz'
+        point_map.save(temp_path)
+        os.rename(temp_path, path)
+
+    def build(self, volumes):
+        """
+        Get the map of each volume, building and caching any that are new.
+
+        Args
+            volumes (list): the volumes to get maps for.
+
+        Returns
+            point_maps (list): a PointSet for each volume, in order.
+
+        """
+
+        point_maps = [self.load(volume.name) for volume in volumes]
+        missing = [i for i, point_map in enumerate(point_maps)
+                   if point_map is None]
+
+        if self.num_workers is None or len(missing) < 2:
+            built_maps = [self._build(volumes[i]) for i in missing]
+        else:
+            built_maps = self._build_parallel(volumes, missing)
+
+        for i, point_map in zip(missing, built_maps):
+            self._save(volumes[i].name, point_map)
+            point_maps[i] = point_map
+
+        return point_maps
+
+    def _build(self, volume):
+        """An internal method to build the map of a single volume."""
+
+        point_map = self.map_function(volume,
+                                      seed=self.volume_seed(volume.name),
+                                      **self.params)
+        if not isinstance(point_map, PointSet):
+            point_map = PointSet.from_mask(point_map)
+
+        return point_map
+
+    def _build_parallel(self, volumes, indices):
+        """An internal method to build maps on a pool of forked workers."""
+
+        global _worker_job
+
+        # Forking lets the workers inherit the builder and the volumes.
+        if hasattr(multiprocessing, 'get_context'):
+            context = multiprocessing.get_context('fork')
+        else:
+            context = multiprocessing
+
+        _worker_job = (self, volumes)
+        pool = context.Pool(min(self.num_workers, len(indices)))
+        try:
+            return pool.map(_build_worker_map, indices)
+        finally:
+            pool.terminate()
+            pool.join()
+            _worker_job = None
+
+
+def _normalise(value):
+    """An internal function to convert a param to plain, ordered values."""
+
+    if isinstance(value, dict):
+        return tuple(sorted((key, _normalise(item))
+                            for key, item in value.items()))
+
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return tuple(_normalise(item) for item in value)
+
+    if isinstance(value, np.generic):
+        return value.item()
+
+    return value
+
+
+def _build_worker_map(index):
+    """An internal function to build a volume's map in a worker process."""
+
+    builder, volumes = _worker_job
+
+    return builder._build(volumes[index])
@@ -0,0 +1,166 @@
+from __future__ import division
+
+import os
+
+
+class PredictionRunner:
+    """
+    Predict on a list of volumes, recording progress so that it can resume.
+
+    Args
+        experiment (Experiment): the experiment to save the predictions and
+            the progress log in.
+        extractor (Extractor): the extractor to predict with.
+        net (nolearn.lasagne.NeuralNet): the net to predict with.
+        batch_size (int): the number of points to evaluate in a batch.
+        bounds_function (function): an optional function that takes a volume
+            and returns the bounds to predict in (e.g. LandmarkROI.bounds).
+        slab_size (int): if given, each volume is predicted a slab of this
+            many slices (along the slice_axis of its sink, the last axis for
+            .nii files) at a time, and each completed slab is recorded, so an
+            interrupted volume only redoes its unfinished slabs.
+        predict_kwargs (dict): any other keyword arguments for
+            Extractor.predict.
+        verbose (bool): whether to print the name of each volume as it is
+            predicted on.
+
+    Attributes
+        experiment (Experiment): equals arg.
+        extractor (Extractor): equals arg.
+        net (nolearn.lasagne.NeuralNet): equals arg.
+        batch_size (int): equals arg.
+        bounds_function (function): equals arg.
+        slab_size (int): equals arg.
+        predict_kwargs (dict): equals arg.
+        verbose (bool): equals arg.
+        log_path (str): the path of the progress log in the experiment
+            directory.
+
+    Notes
+        The probabilities for each volume are streamed into
+        '<name>_prob_seg.nii', and the rounded segmentation is saved to
+        '<name>_seg.nii', as the training scripts name them.  A volume is
+        only recorded as complete once both files have been written, and a
+        slab once its probabilities have been flushed to disk.
+
+    """
+
+    def __init__(self, experiment, extractor, net, batch_size,
+                 bounds_function=None, slab_size=None, predict_kwargs=None,
+                 verbose=False):
+
+        self.experiment = experiment
+        self.extractor = extractor
+        self.net = net
+        self.batch_size = batch_size
+        self.bounds_function = bounds_function
+        self.slab_size = slab_size
+        self.predict_kwargs = predict_kwargs or {}
+        self.verbose = verbose
+        self.log_path = os.path.join(experiment.experiment_path,
+                                     'prediction_log.txt')
+
+    def _read_log(self):
+        """An internal method to read the completed volumes and slabs."""
+
+        completed_volumes = set()
+        completed_slabs = set()
+        if not os.path.isfile(self.log_path):
+            return completed_volumes, completed_slabs
+
+        with open(self.log_path, 'r') as f:
+            for line in f:
+                entry = line.split()
+                if len(entry) == 1:
+                    completed_volumes.add(entry[0])
+                elif len(entry) == 3:
+                    completed_slabs.add((entry[0], int(entry[1]),
+                                         int(entry[2])))
+
+        return completed_volumes, completed_slabs
+
+    def _record(self, *entry):
+        """An internal method to add an entry to the log, durably."""
+
+        with open(self.log_path, 'a') as f:
+            f.write(' '.join(str(item) for item in entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+    def pending(self, volume_names):
+        """Get the names that have not been predicted on yet, in order."""
+
+        completed_volumes, _ = self._read_log()
+
+        return [name for name in volume_names
+                if name not in completed_volumes]
+
+    def run(self, volumes):
+        """
+        Predict on each volume that has not been completed.
+
+        Args
+            volumes (list): the volumes to predict on.  Use pending() first to
+                avoid loading volumes that are already complete.
+
+        Returns
+            predicted_names (list): the names of the volumes predicted on by
+                this call.
+
+        """
+
+        completed_volumes, completed_slabs = self._read_log()
+
+        predicted_names = []
+        for volume in volumes:
+            if volume.name in completed_volumes:
+                continue
+
+            if self.verbose:
+                print("Predicting on volume " + volume.name + ".")
+            bounds = None
+            if self.bounds_function is not None:
+                bounds = self.bounds_function(volume)
+
+            # Stream the probabilities into the experiment directory, keeping
+            # any slabs already completed.
+            sink = self.experiment.create_nii_sink(
+                volume, volume.name + '_prob',
+                resume=self.slab_size is not None)
+
+            if self.slab_size is None:
+                self.extractor.predict(self.net, volume, self.batch_size,
+                                       bounds=bounds, sink=sink,
+                                       **self.predict_kwargs)
+            else:
+                # Cut the slabs along the slowest axis of the sink, so each
+                # slab is a contiguous part of the file.
+                axis = sink.slice_axis
+                for slab_bounds in self._slabs(volume, bounds, axis):
+                    slab_start = slab_bounds[0][axis]
+                    if (volume.name, axis, slab_start) in completed_slabs:
+                        continue
+                    self.extractor.predict(self.net, volume, self.batch_size,
+                                           bounds=slab_bounds, sink=sink,
+                                           **self.predict_kwargs)
+                    self._record(volume.name, axis, slab_start)
+
+            # Save the rounded segmentation, and mark the volume as done.
+            sink.save_rounded(os.path.join(self.experiment.experiment_path,
+                                           volume.name + '_seg.nii'))
+            self._record(volume.name)
+            predicted_names.append(volume.name)
+
+        return predicted_names
+
+    def _slabs(self, volume, bounds, axis):
+        """An internal method to split the prediction box into slabs."""
+
+        lows, highs = self.extractor.valid_box(volume, bounds)
+        for slab_start in range(lows[axis], highs[axis], self.slab_size):
+            slab_lows = list(lows)
+            slab_highs = [high - 1 for high in highs]
+            slab_lows[axis] = slab_start
+            slab_highs[axis] = min(slab_start + self.slab_size,
+                                   highs[axis]) - 1
+            yield slab_lows, slab_highs